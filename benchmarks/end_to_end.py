@@ -0,0 +1,156 @@
+#!/usr/bin/env python
+# times creating, verifying and importing a shipfile of a synthetic closure at
+# each compression level, using fake_nix_store.py in place of nix-store. run
+# from the repository root, e.g.
+#   python benchmarks/end_to_end.py --paths 500 --size 256
+#
+# each phase runs in its own process so its peak RSS can be measured; this
+# includes the fake nix-store processes it starts. verify and import go
+# through the CLI handlers. create can't, as it needs nix to build a flake, so
+# its phase does what create_handler does once the configurations are built.
+
+import argparse
+import os
+import pathlib
+import subprocess
+import sys
+import tempfile
+import time
+
+BENCH_DIR = pathlib.Path(__file__).parent
+sys.path.insert(0, str(BENCH_DIR.parent/"nixos_ship"))
+sys.path.insert(0, str(BENCH_DIR))
+
+from nixos_ship import cli
+from nixos_ship import nix_store
+from nixos_ship import shipfile
+from fake_nix_store import FakeStore
+from synthetic_closure import generate_closure
+
+CONFIG_NAME = "bench"
+
+def create_shipfile(dest_file, top_path, level, export_jobs):
+    with tempfile.TemporaryDirectory() as workdir:
+        sf = shipfile.ShipfileWriter(pathlib.Path(workdir)/"shipfile",
+            dest_file, compression=level)
+        sf.write_version_info()
+
+        with nix_store.LocalStore() as store:
+            path_infos = nix_store.sort_path_infos(
+                store.query_path_infos(store.query_closure([top_path])))
+
+            sf.write_config_info({CONFIG_NAME: top_path})
+            sf.write_store_info()
+            for path_info in path_infos:
+                sf.write_narinfo(path_info, in_file=True)
+
+            with nix_store.NarPrefetcher(store, path_infos,
+                    jobs=export_jobs) as prefetcher:
+                for path_info in path_infos:
+                    prefetcher.source_nar_into(path_info.path,
+                        path_info.nar_size,
+                        lambda nar_fp: sf.sink_nar_into(path_info.nar_hash,
+                            path_info.nar_size, nar_fp))
+
+        sf.close()
+
+def run_phase(phase, args):
+    # runs in the child process
+    if phase == "create":
+        dest_file, top_path, level, export_jobs = args
+        create_shipfile(dest_file, top_path, level, int(export_jobs))
+    elif phase == "cli":
+        cli.main("nixos-ship", args)
+
+def time_phase(env, phase, *args):
+    # run a phase in a new process, returning the seconds it took and its peak
+    # RSS in bytes
+    start = time.perf_counter()
+    proc = subprocess.Popen([sys.executable, __file__, "--phase", phase,
+        *args], env=env, stdout=subprocess.DEVNULL)
+    _, status, rusage = os.wait4(proc.pid, 0)
+    elapsed = time.perf_counter() - start
+    proc.returncode = os.waitstatus_to_exitcode(status)
+    if proc.returncode != 0:
+        raise RuntimeError(f"{phase} {' '.join(args)} failed")
+
+    return elapsed, rusage.ru_maxrss*1024
+
+def make_fake_nix_store_bin(bin_dir):
+    # put the fake store on the PATH under the name nixos-ship runs
+    bin_dir.mkdir()
+    script = bin_dir/"nix-store"
+    script.write_text("#!/bin/sh\n"
+        f"exec '{sys.executable}' '{BENCH_DIR/'fake_nix_store.py'}' \"$@\"\n")
+    script.chmod(0o755)
+
+def main():
+    if len(sys.argv) > 2 and sys.argv[1] == "--phase":
+        run_phase(sys.argv[2], sys.argv[3:])
+        return
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--paths", type=int, default=500,
+        help="number of paths in the synthetic closure")
+    parser.add_argument("--size", type=int, default=256,
+        help="roughly how many MiB of files the closure has")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--levels", type=str, nargs="+",
+        choices=["ultra", "normal", "fast"],
+        default=["fast", "normal", "ultra"],
+        help="compression levels to test")
+    parser.add_argument("--export-jobs", type=int, default=2)
+    parser.add_argument("--jobs", type=int, default=1,
+        help="store connections to import with")
+    parser.add_argument("--workdir", type=str,
+        help="directory to work in and leave the results in, instead of a "
+            "temporary one")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        workdir = pathlib.Path(args.workdir or tmp_dir)
+        workdir.mkdir(parents=True, exist_ok=True)
+
+        print("Generating synthetic closure...")
+        source_root = workdir/"source"
+        top_path = generate_closure(source_root, args.paths,
+            args.size*1048576, args.seed)
+        source = FakeStore(source_root)
+        closure_infos = [source.path_info(f"/nix/store/{f.stem}")
+            for f in (source_root/"nix/var/fake-nix-store/info").iterdir()]
+        nar_bytes = sum(p.nar_size for p in closure_infos)
+        print(f"{len(closure_infos)} paths, {nar_bytes/1e6:.1f} MB of nars")
+
+        make_fake_nix_store_bin(workdir/"bin")
+        env = dict(os.environ,
+            PATH=f"{workdir/'bin'}{os.pathsep}{os.environ['PATH']}",
+            FAKE_NIX_STORE_ROOT=str(source_root))
+
+        print(f"{'level':>8} {'phase':>8} {'MB/s':>8} {'peak RSS':>10} "
+            f"{'ratio':>7}")
+        for level in args.levels:
+            shf = workdir/f"bench_{level}.shf"
+            dest_root = workdir/f"dest_{level}"
+
+            phases = [
+                ("create", time_phase(env, "create", str(shf), top_path,
+                    level, str(args.export_jobs))),
+                ("verify", time_phase(env, "cli", "verify", str(shf))),
+                ("import", time_phase(env, "cli", "import", str(shf),
+                    "-n", CONFIG_NAME, "--root", str(dest_root),
+                    "-j", str(args.jobs))),
+            ]
+
+            # make sure the import actually brought everything over
+            dest = FakeStore(dest_root)
+            for path_info in closure_infos:
+                if dest.path_info(path_info.path) != path_info:
+                    raise RuntimeError(f"{path_info.path} wasn't imported")
+
+            ratio = nar_bytes/shf.stat().st_size
+            for phase, (elapsed, peak_rss) in phases:
+                print(f"{level:>8} {phase:>8} {nar_bytes/1e6/elapsed:8.1f} "
+                    f"{peak_rss/1048576:7.1f} MiB {ratio:7.2f}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,211 @@
+#!/usr/bin/env python
+# a stand-in for nix-store --serve --write, so shipfiles can be created and
+# imported without a real nix store. it speaks just enough of the protocol for
+# StoreCommunicator: the handshake, QUERY_VALID_PATHS, QUERY_PATH_INFOS,
+# QUERY_CLOSURE, DUMP_STORE_PATH and ADD_TO_STORE_NAR.
+#
+# the store lives under the --store root, or $FAKE_NIX_STORE_ROOT if that's
+# not given. path contents are in nix/store like a real store, but the path
+# info of each valid path is a JSON file in nix/var/fake-nix-store/info. nars
+# added to the store are kept as they are in nix/var/fake-nix-store/nar
+# instead of being unpacked. see synthetic_closure.py for making a store.
+
+import hashlib
+import json
+import os
+import pathlib
+import struct
+import sys
+
+sys.path.insert(0, str(pathlib.Path(__file__).parent.parent/"nixos_ship"))
+
+from nixos_ship import nar
+from nixos_ship.nix_store import (SERVE_MAGIC_1, SERVE_MAGIC_2,
+    PROTOCOL_VERSION, ServeCommand, PathInfo, sort_paths)
+
+class FakeStore:
+    def __init__(self, root):
+        self.root = pathlib.Path(root)
+        self._info_dir = self.root/"nix/var/fake-nix-store/info"
+        self._nar_dir = self.root/"nix/var/fake-nix-store/nar"
+        self._info_dir.mkdir(parents=True, exist_ok=True)
+        self._nar_dir.mkdir(parents=True, exist_ok=True)
+
+    def path_info(self, path):
+        try:
+            info = (self._info_dir/f"{path[11:]}.json").read_text()
+        except FileNotFoundError:
+            return None
+        return PathInfo(**json.loads(info))
+
+    def register(self, path_info):
+        # several connections can add paths at once, so make each info appear
+        # all at once
+        info_path = self._info_dir/f"{path_info.path[11:]}.json"
+        tmp_path = info_path.with_suffix(f".tmp{os.getpid()}")
+        tmp_path.write_text(json.dumps(path_info._asdict()))
+        tmp_path.rename(info_path)
+
+    def nar_path(self, path):
+        return self._nar_dir/f"{path[11:]}.nar"
+
+    def dump_nar(self, path):
+        # nars added to the store are kept whole, anything else is dumped
+        nar_path = self.nar_path(path)
+        if nar_path.exists():
+            with open(nar_path, "rb") as f:
+                while True:
+                    chunk = f.read(nar.DUMP_CHUNK_SIZE)
+                    if len(chunk) == 0:
+                        break
+                    yield chunk
+        else:
+            yield from nar.dump_nar(self.root/path.lstrip("/"))
+
+class ServeConnection:
+    def __init__(self, store, fin, fout):
+        self._store = store
+        self._fin = fin
+        self._fout = fout
+
+    def _read_num(self):
+        data = self._fin.read(8)
+        if len(data) < 8:
+            raise EOFError
+        return struct.unpack("<Q", data)[0]
+
+    def _read_string(self):
+        length = self._read_num()
+        data = self._fin.read((length+7) & ~7)
+        return data[:length].decode("utf8")
+
+    def _read_strings(self):
+        return [self._read_string() for _ in range(self._read_num())]
+
+    def _write_num(self, num):
+        self._fout.write(struct.pack("<Q", num))
+
+    def _write_string(self, string):
+        data = string.encode("utf8")
+        self._fout.write(struct.pack("<Q", len(data)) + data +
+            b"\x00"*(-len(data)%8))
+
+    def _write_strings(self, strings):
+        self._write_num(len(strings))
+        for string in strings:
+            self._write_string(string)
+
+    def serve(self):
+        if self._read_num() != SERVE_MAGIC_1:
+            sys.exit("fake nix-store: bad magic")
+        self._write_num(SERVE_MAGIC_2)
+        self._write_num(PROTOCOL_VERSION)
+        self._fout.flush()
+        self._read_num() # client version
+
+        handlers = {
+            ServeCommand.QUERY_VALID_PATHS: self._query_valid_paths,
+            ServeCommand.QUERY_PATH_INFOS: self._query_path_infos,
+            ServeCommand.DUMP_STORE_PATH: self._dump_store_path,
+            ServeCommand.QUERY_CLOSURE: self._query_closure,
+            ServeCommand.ADD_TO_STORE_NAR: self._add_to_store_nar,
+        }
+        while True:
+            try:
+                command = self._read_num()
+            except EOFError:
+                return
+            if command not in handlers:
+                sys.exit(f"fake nix-store: unsupported command {command}")
+            handlers[command]()
+            self._fout.flush()
+
+    def _query_valid_paths(self):
+        self._read_num() # lock
+        self._read_num() # substitute
+        paths = self._read_strings()
+        self._write_strings(sorted(p for p in set(paths)
+            if self._store.path_info(p) is not None))
+
+    def _query_path_infos(self):
+        for path in sorted(set(self._read_strings())):
+            info = self._store.path_info(path)
+            if info is None:
+                continue
+            self._write_string(info.path)
+            self._write_string(info.deriver)
+            self._write_strings(info.references)
+            self._write_num(info.nar_size)
+            self._write_num(info.nar_size)
+            self._write_string(info.nar_hash)
+            self._write_string(info.ca_info)
+            self._write_strings(info.sigs)
+        self._write_string("")
+
+    def _query_closure(self):
+        self._read_num() # include outputs
+        todo = self._read_strings()
+        closure = set()
+        while len(todo) > 0:
+            path = todo.pop()
+            if path in closure:
+                continue
+            info = self._store.path_info(path)
+            if info is None:
+                sys.exit(f"fake nix-store: path '{path}' is not valid")
+            closure.add(path)
+            todo.extend(info.references)
+        self._write_strings(sorted(closure))
+
+    def _dump_store_path(self):
+        path = self._read_string()
+        if self._store.path_info(path) is None:
+            sys.exit(f"fake nix-store: path '{path}' is not valid")
+        for chunk in self._store.dump_nar(path):
+            self._fout.write(chunk)
+
+    def _add_to_store_nar(self):
+        path = self._read_string()
+        deriver = self._read_string()
+        nar_hash = self._read_string()
+        references = self._read_strings()
+        self._read_num() # registration time
+        nar_size = self._read_num()
+        self._read_num() # ultimate
+        sigs = self._read_strings()
+        ca_info = self._read_string()
+
+        # check the hash like the real store does
+        digest = hashlib.sha256()
+        remaining = nar_size
+        with open(self._store.nar_path(path), "wb") as f:
+            while remaining > 0:
+                chunk = self._fin.read(min(remaining, nar.DUMP_CHUNK_SIZE))
+                if len(chunk) == 0:
+                    raise EOFError
+                digest.update(chunk)
+                f.write(chunk)
+                remaining -= len(chunk)
+        if not nar.nar_hash_matches(nar_hash, digest.digest()):
+            sys.exit(f"fake nix-store: hash mismatch importing '{path}'")
+
+        self._store.register(PathInfo(path=path, deriver=deriver,
+            references=sort_paths(references), nar_size=nar_size,
+            nar_hash=nar_hash, ca_info=ca_info, sigs=sorted(sigs)))
+        self._write_num(1)
+
+def main():
+    args = sys.argv[1:]
+    if "--serve" not in args:
+        sys.exit("fake nix-store: only --serve is supported")
+
+    root = ""
+    if "--store" in args:
+        root = args[args.index("--store")+1]
+    root = root or os.environ["FAKE_NIX_STORE_ROOT"]
+
+    ServeConnection(FakeStore(root), sys.stdin.buffer,
+        sys.stdout.buffer).serve()
+
+if __name__ == "__main__":
+    main()
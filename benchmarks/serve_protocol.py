@@ -0,0 +1,122 @@
+#!/usr/bin/env python
+# measures how fast StoreCommunicator parses the replies of nix-store --serve,
+# to judge changes to how it reads them. the replies come from a transcript of
+# a real store, recorded with
+#   python benchmarks/serve_protocol.py --record serve.bin /run/current-system
+# and replayed with
+#   python benchmarks/serve_protocol.py --transcript serve.bin
+# without a transcript, replies for a made up closure are used instead.
+#
+# a parser reading replies in chunks into a buffer and decoding them with
+# struct.unpack_from was tried and declined: on a real pipe it was only about
+# 1.02x faster than reading each field, and it left bytes buffered that the
+# nar dump after the replies then had to be checked against.
+
+import argparse
+import io
+import pathlib
+import subprocess
+import sys
+import time
+
+sys.path.insert(0, str(pathlib.Path(__file__).parent.parent/"nixos_ship"))
+
+from nixos_ship import nix_store
+
+class NullWriter:
+    def write(self, data):
+        return len(data)
+
+    def flush(self):
+        pass
+
+class RecordingReader:
+    # keep a copy of everything read out of fp
+    def __init__(self, fp):
+        self._fp = fp
+        self.data = bytearray()
+
+    def read(self, size):
+        data = self._fp.read(size)
+        self.data += data
+        return data
+
+def record(path, roots):
+    proc = subprocess.Popen(["nix-store", "--serve"],
+        stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+    reader = RecordingReader(proc.stdout)
+    try:
+        store = nix_store.StoreCommunicator(reader, proc.stdin)
+        closure = store.query_closure(roots)
+        store.query_path_infos(closure)
+    finally:
+        proc.stdin.close()
+        proc.wait()
+
+    pathlib.Path(path).write_bytes(reader.data)
+    print(f"recorded {len(reader.data)} bytes for {len(closure)} paths")
+
+def make_transcript(num_paths):
+    # the store's side of the handshake, a closure and its path infos
+    out = io.BytesIO()
+    store = nix_store.StoreCommunicator.__new__(nix_store.StoreCommunicator)
+    store._fout = out
+
+    store._write_num(nix_store.SERVE_MAGIC_2)
+    store._write_num(nix_store.PROTOCOL_VERSION)
+
+    paths = [f"/nix/store/{idx:032d}-package-{idx}" for idx in range(num_paths)]
+    store._write_strings(paths)
+    for idx, path in enumerate(paths):
+        store._write_string(path)
+        store._write_string(f"/nix/store/{idx:032d}-package-{idx}.drv")
+        store._write_strings(paths[max(0, idx-10):idx])
+        store._write_num(idx*1000)
+        store._write_num(idx*1000)
+        store._write_string(f"sha256:{idx:052d}")
+        store._write_string("")
+        store._write_strings([f"cache.example.org-1:{idx:086d}=="])
+    store._write_string("")
+
+    return out.getvalue()
+
+def replay(transcript):
+    store = nix_store.StoreCommunicator(
+        io.BufferedReader(io.BytesIO(transcript)), NullWriter())
+    closure = store.query_closure(["/nix/store/root"])
+    return store.query_path_infos(closure)
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--record", type=str, metavar="FILE",
+        help="record a transcript of querying the closure of the given store "
+            "paths into FILE instead of benchmarking")
+    parser.add_argument("--transcript", type=str, metavar="FILE",
+        help="transcript to replay")
+    parser.add_argument("--paths", type=int, default=50000,
+        help="number of paths in the made up closure without a transcript")
+    parser.add_argument("--repeat", type=int, default=3,
+        help="times to run the benchmark, keeping the fastest")
+    parser.add_argument("roots", nargs="*",
+        help="store paths to query the closure of when recording")
+    args = parser.parse_args()
+
+    if args.record is not None:
+        record(args.record, args.roots)
+        return
+
+    if args.transcript is not None:
+        transcript = pathlib.Path(args.transcript).read_bytes()
+    else:
+        transcript = make_transcript(args.paths)
+
+    elapsed = None
+    for _ in range(args.repeat):
+        start = time.perf_counter()
+        path_infos = replay(transcript)
+        elapsed = min(elapsed or float("inf"), time.perf_counter() - start)
+
+    print(f"{len(path_infos)/elapsed:.0f} paths/s")
+
+if __name__ == "__main__":
+    main()
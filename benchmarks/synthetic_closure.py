@@ -0,0 +1,157 @@
+#!/usr/bin/env python
+# makes a fake nix store holding a made up system closure for benchmarking,
+# laid out for fake_nix_store.py. like a real system, most paths are small
+# and a few are huge (the sizes are log-normal), a handful of libraries are
+# referenced by almost everything, and the contents compress about as well
+# as real binaries and text. the same seed always gives the same store. e.g.
+#   python benchmarks/synthetic_closure.py /tmp/bench-store --size 1024
+
+import argparse
+import hashlib
+import math
+import pathlib
+import random
+import sys
+
+sys.path.insert(0, str(pathlib.Path(__file__).parent.parent/"nixos_ship"))
+sys.path.insert(0, str(pathlib.Path(__file__).parent))
+
+from nixos_ship import nar
+from nixos_ship.nix_store import PathInfo, sort_paths
+from fake_nix_store import FakeStore
+
+WORDS = ("the of and to in is for on that by with this from are be or as at "
+    "library function return value error file path store system config "
+    "option default module package build output version license").split()
+
+def make_store_path(rnd, name):
+    digest = rnd.getrandbits(160).to_bytes(20, "little")
+    return f"/nix/store/{nar.nix_base32_encode(digest)}-{name}"
+
+def make_text(rnd, size):
+    # some random words, then pieces of them over and over to save time
+    words = []
+    length = 0
+    while length < min(size, 65536):
+        word = rnd.choice(WORDS)
+        words.append(word)
+        length += len(word)+1
+    pool = " ".join(words).encode("utf8")
+
+    data = bytearray(pool)
+    while len(data) < size:
+        start = rnd.randrange(len(pool))
+        data += pool[start:start+rnd.randint(64, 4096)]
+    return bytes(data[:size])
+
+def make_binary(rnd, size):
+    # random runs mixed with runs repeated from earlier, roughly like code
+    data = bytearray()
+    while len(data) < size:
+        run = rnd.randint(16, 4096)
+        if len(data) > run and rnd.random() < 0.6:
+            start = rnd.randrange(len(data)-run)
+            data += data[start:start+run]
+        else:
+            data += rnd.randbytes(run)
+    return bytes(data[:size])
+
+def write_contents(rnd, path, size):
+    # fill a directory with about size bytes of files
+    (path/"bin").mkdir(parents=True)
+    (path/"lib").mkdir()
+    (path/"share/doc").mkdir(parents=True)
+
+    num_files = max(1, min(200, int(math.sqrt(size/4096))))
+    for idx in range(num_files):
+        file_size = rnd.randint(0, 2*size//num_files)
+        kind = rnd.random()
+        if kind < 0.2:
+            file_path = path/"bin"/f"prog{idx}"
+            file_path.write_bytes(make_binary(rnd, file_size))
+            file_path.chmod(0o555)
+        elif kind < 0.7:
+            (path/"lib"/f"lib{idx}.so").write_bytes(
+                make_binary(rnd, file_size))
+        else:
+            (path/"share/doc"/f"doc{idx}.txt").write_bytes(
+                make_text(rnd, file_size))
+
+    (path/"lib/libdefault.so").symlink_to(
+        f"lib{rnd.randrange(num_files)}.so")
+
+def generate_closure(root, num_paths=500, total_size=256*1048576, seed=0):
+    # generate a store under root with a closure of num_paths paths of about
+    # total_size bytes, and return the path at the top of it
+    rnd = random.Random(seed)
+    store = FakeStore(root)
+
+    sizes = [rnd.lognormvariate(0, 2) for _ in range(num_paths)]
+    scale = total_size/sum(sizes)
+    sizes = [max(1024, int(s*scale)) for s in sizes]
+
+    paths = []
+    popularity = []
+    referenced = set()
+    for idx, size in enumerate(sizes):
+        store_path = make_store_path(rnd, f"package-{idx}")
+        fs_path = store.root/store_path.lstrip("/")
+        write_contents(rnd, fs_path, size)
+
+        # popular paths like libc get more popular as they are picked
+        references = set()
+        if len(paths) > 0:
+            for _ in range(min(len(paths), rnd.randint(0, 8))):
+                ref_idx = rnd.choices(range(len(paths)), popularity)[0]
+                references.add(paths[ref_idx])
+                popularity[ref_idx] += 1
+        referenced.update(references)
+
+        register(store, store_path, fs_path, references)
+        paths.append(store_path)
+        popularity.append(1)
+
+    # the system pulls in everything nothing else does
+    top_path = make_store_path(rnd, "nixos-system-bench")
+    fs_path = store.root/top_path.lstrip("/")
+    fs_path.mkdir(parents=True)
+    (fs_path/"paths").write_text("\n".join(paths))
+    register(store, top_path, fs_path,
+        [p for p in paths if p not in referenced])
+
+    return top_path
+
+def register(store, store_path, fs_path, references):
+    digest = hashlib.sha256()
+    nar_size = 0
+    for piece in nar.dump_nar(fs_path):
+        digest.update(piece)
+        nar_size += len(piece)
+
+    store.register(PathInfo(
+        path=store_path,
+        deriver="",
+        references=sort_paths(references),
+        nar_size=nar_size,
+        nar_hash=nar.format_nar_hash(digest.digest()),
+        ca_info="",
+        sigs=[],
+    ))
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("root", type=str,
+        help="directory to make the store in")
+    parser.add_argument("--paths", type=int, default=500,
+        help="number of paths in the closure")
+    parser.add_argument("--size", type=int, default=256,
+        help="roughly how many MiB of files the closure has")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    top_path = generate_closure(args.root, args.paths, args.size*1048576,
+        args.seed)
+    print(top_path)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,105 @@
+#!/usr/bin/env python
+# measures how fast nars can be written into a shipfile compared to just
+# compressing the same data with zstd, to show how much time is lost to python
+# on the way. run from the repository root, e.g.
+#   python benchmarks/write_throughput.py --level fast --size 1024
+
+import argparse
+import io
+import os
+import pathlib
+import sys
+import tarfile
+import tempfile
+import time
+
+sys.path.insert(0, str(pathlib.Path(__file__).parent.parent/"nixos_ship"))
+
+from nixos_ship import shipfile
+
+class NullWriter:
+    def write(self, data):
+        return len(data)
+
+def make_nars(total_size, nar_size):
+    # half random and half repeated so the compressor has to do some work
+    chunk = os.urandom(nar_size//2)
+    nars = []
+    while total_size > 0:
+        size = min(nar_size, total_size)
+        nars.append((chunk+os.urandom(nar_size//2))[:size])
+        total_size -= size
+    return nars
+
+def bench_zstd(level, nars):
+    # the best we could do: compress the data with no tar or shipfile at all
+    writer = shipfile.get_compressor(level).stream_writer(NullWriter(),
+        write_size=shipfile.WRITE_BUFFER_SIZE)
+    for nar in nars:
+        writer.write(nar)
+    writer.flush()
+
+def bench_tarfile(level, nars):
+    # the previous approach of giving each nar to tarfile.addfile
+    writer = shipfile.get_compressor(level).stream_writer(NullWriter())
+    tar = tarfile.open(fileobj=writer, mode="w:", format=tarfile.PAX_FORMAT)
+    for idx, nar in enumerate(nars):
+        info = tarfile.TarInfo(f"shipfile/store/nar/{idx}.nar")
+        info.size = len(nar)
+        tar.addfile(info, io.BytesIO(nar))
+    tar.close()
+    writer.flush()
+
+def bench_shipfile(level, nars, split_size, out_dir):
+    path = "/dev/null" if split_size is None else out_dir/"bench.shf"
+    sf = shipfile.ShipfileWriter(out_dir/f"work_{time.monotonic_ns()}", path,
+        compression=level, split_size=split_size)
+    for idx, nar in enumerate(nars):
+        nar_hash = f"sha256:{idx:052d}"
+        sf.sink_nar_into(nar_hash, len(nar), io.BytesIO(nar))
+    sf.close()
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--level", choices=["ultra", "normal", "fast"],
+        default="fast")
+    parser.add_argument("--size", type=int, default=512,
+        help="total MiB of nar data to write")
+    parser.add_argument("--nar-size", type=int, default=16,
+        help="MiB in each nar")
+    parser.add_argument("--split", type=int,
+        help="also split the shipfile into parts of this many MiB, which "
+            "are written to a temporary directory instead of /dev/null")
+    parser.add_argument("--repeat", type=int, default=3,
+        help="times to run each benchmark, keeping the fastest")
+    args = parser.parse_args()
+
+    nars = make_nars(args.size*1048576, args.nar_size*1048576)
+    split_size = None if args.split is None else args.split*1048576
+
+    with tempfile.TemporaryDirectory() as out_dir:
+        out_dir = pathlib.Path(out_dir)
+        benches = [
+            ("zstd only", lambda: bench_zstd(args.level, nars)),
+            ("tarfile.addfile", lambda: bench_tarfile(args.level, nars)),
+            ("ShipfileWriter", lambda: bench_shipfile(args.level, nars,
+                split_size, out_dir)),
+        ]
+
+        baseline = None
+        for name, fn in benches:
+            elapsed = None
+            for _ in range(args.repeat):
+                start = time.perf_counter()
+                fn()
+                elapsed = min(elapsed or float("inf"),
+                    time.perf_counter() - start)
+            if baseline is None:
+                baseline = elapsed
+
+            rate = args.size/elapsed
+            overhead = (elapsed/baseline - 1)*100
+            print(f"{name:>16}: {rate:8.1f} MiB/s, {overhead:+6.1f}% vs zstd")
+
+if __name__ == "__main__":
+    main()
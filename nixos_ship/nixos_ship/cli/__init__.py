@@ -3,6 +3,8 @@ import argparse
 from .create import build_create_parser
 from .import_cmd import build_import_parser
 from .install import build_install_parser
+from .manifest import build_manifest_parser
+from .verify import build_verify_parser
 
 def parse_args(program, args):
     main_parser = argparse.ArgumentParser(prog=program)
@@ -16,6 +18,8 @@ def parse_args(program, args):
         build_create_parser(subparsers),
         build_import_parser(subparsers),
         build_install_parser(subparsers),
+        build_manifest_parser(subparsers),
+        build_verify_parser(subparsers),
     ]
 
     return main_parser.parse_args(args)
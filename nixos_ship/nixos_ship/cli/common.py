@@ -0,0 +1,17 @@
+# arguments shared by several subcommands
+
+def add_stats_arguments(parser):
+    parser.add_argument("--stats", action="store_true",
+        help="print how long each phase took and how much data went through "
+            "it at the end",
+    )
+
+    parser.add_argument("--stats-json", type=str, metavar="FILE",
+        help="write the same numbers as --stats, plus the compression ratio "
+            "of each nar, to FILE as JSON",
+    )
+
+    parser.add_argument("--trace", type=str, metavar="FILE",
+        help="write a timeline of what each thread did with each nar to FILE "
+            "as a Chrome trace, for chrome://tracing or ui.perfetto.dev",
+    )
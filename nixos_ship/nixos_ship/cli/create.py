@@ -1,13 +1,20 @@
+import contextlib
 import json
-import itertools
 import re
 
 from ..workdir import Workdir
 
 from .. import git_tools
+from .. import manifest
+from .. import nar_cache
 from .. import nix_tools
 from .. import shipfile
 from .. import nix_store
+from .. import nix_db
+from .. import path_info_cache
+from .. import stats
+
+from .common import add_stats_arguments
 
 def build_create_parser(subparsers):
     import argparse
@@ -35,7 +42,8 @@ def build_create_parser(subparsers):
         "create", help="create a shipfile")
 
     create_parser.add_argument(
-        "dest_file", type=str
+        "dest_file", type=str,
+        help="file to write the shipfile to, or - for stdout"
     )
 
     create_parser.add_argument(
@@ -48,6 +56,17 @@ def build_create_parser(subparsers):
         help="rev we assume the recipient already has"
     )
 
+    create_parser.add_argument("--have", type=str, action="append",
+        default=[], metavar="MANIFEST",
+        help="manifest of paths the recipient already has; may be given "
+            "more than once to ship what any of them is missing"
+    )
+
+    create_parser.add_argument("--nar-patch", action="store_true",
+        help="ship changed paths as patches against the same paths in the "
+            "--delta rev"
+    )
+
     create_parser.add_argument(
         "--level", type=str, choices=["ultra", "normal", "fast"],
         default="normal",
@@ -62,6 +81,56 @@ def build_create_parser(subparsers):
         help="size of each shipfile part; supports KMGT as 2**10 suffixes",
     )
 
+    create_parser.add_argument("--seekable", action="store_true",
+        help="compress each store path separately so importing can skip "
+            "straight to the ones it needs, at some cost in size",
+    )
+
+    create_parser.add_argument("--file-dedup", action="store_true",
+        help="store files which appear in several paths only once; "
+            "importing holds the ones it needs in temporary space"
+    )
+
+    create_parser.add_argument("--nar-cache", type=str, metavar="DIR",
+        help="directory to keep compressed paths in for reuse by later "
+            "shipfiles; implies --seekable"
+    )
+
+    create_parser.add_argument("--nar-cache-size", type=parse_size,
+        default=16*2**30,
+        help="maximum size of the nar cache; supports KMGT as 2**10 suffixes",
+    )
+
+    create_parser.add_argument("--export-jobs", type=int, default=2,
+        help="number of extra store connections exporting paths ahead of "
+            "compression; 0 to export one at a time",
+    )
+
+    create_parser.add_argument("--export-buffer", type=parse_size,
+        default=268435456,
+        help="maximum size of exported paths waiting for compression; "
+            "supports KMGT as 2**10 suffixes",
+    )
+
+    create_parser.add_argument("--direct-dump", action="store_true",
+        help="read paths straight out of /nix/store instead of exporting "
+            "them through nix-store; --export-jobs then sets the number of "
+            "threads doing so"
+    )
+
+    create_parser.add_argument("--direct-db", action="store_true",
+        help="read closures and path infos straight out of the nix database "
+            "instead of asking nix-store, if it can be read"
+    )
+
+    create_parser.add_argument("--path-info-cache", type=str, metavar="FILE",
+        help="file to remember store path infos in for reuse by later "
+            "shipfiles; delete it if a store path is ever rebuilt with "
+            "different contents"
+    )
+
+    add_stats_arguments(create_parser)
+
     create_parser.set_defaults(handler=create_handler)
     return create_parser
 
@@ -91,10 +160,75 @@ def build_flake_configs(flake_path, config_names):
 
     return config_paths
 
+# largest nar we will patch or use as a patch base; both have to fit in memory
+# and in the compression window together
+MAX_PATCH_NAR_SIZE = 2**30
+
+def find_patch_bases(config_closures, delta_config_closures, path_infos,
+        query_path_infos):
+    # pair each path to ship with a path of the same name that every config
+    # needing it already has, keyed by nar hash as that is how the nar is found
+
+    # map name -> paths with that name for each config's delta closure
+    delta_names = {}
+    for name, closure in delta_config_closures.items():
+        names = delta_names.setdefault(name, {})
+        for path in closure:
+            names.setdefault(path[44:], set()).add(path)
+
+    path_configs = {}
+    for name, closure in config_closures.items():
+        for path in closure:
+            path_configs.setdefault(path, []).append(name)
+
+    path_bases = {}
+    for path, names in path_configs.items():
+        bases = None
+        for name in names:
+            candidates = delta_names[name].get(path[44:], set())
+            bases = candidates if bases is None else bases & candidates
+        if bases:
+            path_bases[path] = nix_store.sort_paths(bases)[0]
+
+    base_infos = {p.path: p for p in
+        query_path_infos(sorted(set(path_bases.values())))}
+
+    patch_bases = {}
+    for path_info in path_infos:
+        if path_info.path not in path_bases or \
+                path_info.nar_hash in patch_bases:
+            continue
+        base_info = base_infos[path_bases[path_info.path]]
+        if path_info.nar_size <= MAX_PATCH_NAR_SIZE and \
+                base_info.nar_size <= MAX_PATCH_NAR_SIZE:
+            patch_bases[path_info.nar_hash] = base_info
+
+    return patch_bases
+
 def create_handler(args):
+    with stats.collecting("create", args.stats, args.stats_json,
+            args.trace):
+        create(args)
+
+def create(args):
+    if args.nar_patch and args.delta is None:
+        raise ValueError("--nar-patch requires --delta")
+    if args.nar_patch and args.file_dedup:
+        raise ValueError("--nar-patch and --file-dedup can't be used together")
+
+    if args.dest_file == "-":
+        # keep everything else out of the shipfile data from the start
+        shipfile.claim_stdout()
+
     name_regex = re.compile(args.name)
     source_rev = git_tools.get_commit(args.rev)
 
+    have_manifests = [manifest.read_manifest(f) for f in args.have]
+
+    cache = None
+    if args.nar_cache is not None:
+        cache = nar_cache.NarCache(args.nar_cache, args.nar_cache_size)
+
     with Workdir(autoprune=True) as workdir:
         flake_path = workdir/"worktree"
         git_tools.create_worktree(flake_path, source_rev)
@@ -104,56 +238,186 @@ def create_handler(args):
             git_tools.create_worktree(delta_flake_path,
                 git_tools.get_commit(args.delta))
 
-        config_names = get_config_names(flake_path, name_regex)
-        config_paths = build_flake_configs(flake_path, config_names)
+        with stats.phase("evaluate"):
+            config_names = get_config_names(flake_path, name_regex)
+        with stats.phase("build"):
+            config_paths = build_flake_configs(flake_path, config_names)
 
         if args.delta is not None:
-            delta_config_names = get_config_names(delta_flake_path, name_regex)
-            delta_config_paths = build_flake_configs(
-                delta_flake_path, delta_config_names)
+            with stats.phase("evaluate"):
+                delta_config_names = get_config_names(delta_flake_path,
+                    name_regex)
+            with stats.phase("build"):
+                delta_config_paths = build_flake_configs(
+                    delta_flake_path, delta_config_names)
 
         sf = shipfile.ShipfileWriter(workdir/"shipfile", args.dest_file,
             compression=args.level,
-            split_size=args.split)
-        sf.write_version_info()
+            split_size=args.split,
+            seekable=args.seekable or cache is not None,
+            file_dedup=args.file_dedup,
+            nar_cache=cache)
+        sf.write_version_info(
+            mandatory_features=["nar_patch"] if args.nar_patch else [])
+
+        with contextlib.ExitStack() as stack:
+            store = stack.enter_context(nix_store.LocalStore())
+            # where closures and path infos come from
+            metadata = store
+            if args.direct_db:
+                metadata = stack.enter_context(
+                    nix_db.StoreMetadataBackend(store))
+                if not metadata.using_db:
+                    print("Can't read the nix database, asking nix-store "
+                        "instead...")
+
+            query_path_infos = metadata.query_path_infos
+            if args.path_info_cache is not None:
+                info_cache = stack.enter_context(
+                    path_info_cache.PathInfoCache(args.path_info_cache))
+                query_path_infos = lambda paths: \
+                    info_cache.query_path_infos(metadata, paths)
+
+            # where nars are exported from
+            if args.direct_dump:
+                nar_store = nix_store.DirectNarSource()
+            else:
+                nar_store = store
 
-        with nix_store.LocalStore() as store:
             print("Computing set of paths to ship...")
-            config_closures = {name: store.query_closure([path])
-                for name, path in config_paths.items()}
-
-            paths = set(itertools.chain(*config_closures.values()))
-            path_infos = store.query_path_infos(list(paths))
+            # ask for all the closures at once instead of waiting on each
+            closure_paths = [list(config_paths.values())]
+            if args.delta is not None:
+                closure_paths.extend([path]
+                    for path in delta_config_paths.values())
+            with stats.phase("query"):
+                closure, *delta_closures = \
+                    metadata.query_closures(closure_paths)
+                path_infos = query_path_infos(closure)
             path_infos = nix_store.sort_path_infos(path_infos)
 
+            # work out what each config needs from the combined closure
+            graph = nix_store.StoreGraph(path_infos)
+            config_sets = {name: graph.closure([path])
+                for name, path in config_paths.items()}
+
             if args.delta is not None:
-                delta_config_closures = {name: set(store.query_closure([path]))
-                    for name, path in delta_config_paths.items()}
+                delta_config_closures = {name: set(delta_closure)
+                    for name, delta_closure in zip(delta_config_paths.keys(),
+                        delta_closures)}
                 # if the new config has new systems, pretend there's nothing
                 # from any old systems
-                for name in config_closures.keys():
+                for name in config_sets.keys():
                     delta_config_closures.setdefault(name, set())
 
                 # assume each system only has its delta system present, and not
                 # other systems
-                config_closures = {name:
-                    [p for p in paths if p not in delta_config_closures[name]]
-                    for name, paths in config_closures.items()
+                config_sets = {name: graph.difference(path_set,
+                        graph.path_set(delta_config_closures[name]))
+                    for name, path_set in config_sets.items()
                 }
 
-                paths = set(itertools.chain(*config_closures.values()))
+            if len(have_manifests) > 0:
+                # leave out what the recipients say they already have
+                have_set = graph.path_set(p for p in graph.paths
+                    if all(p in m for m in have_manifests))
+                config_sets = {name: graph.difference(path_set, have_set)
+                    for name, path_set in config_sets.items()
+                }
+
+            config_closures = {name: graph.paths_in(path_set)
+                for name, path_set in config_sets.items()}
+            ship_set = graph.union(*config_sets.values())
+            paths = set(graph.paths_in(ship_set))
+
+            ship_path_infos = [p for p in path_infos
+                if ship_set[graph.id(p.path)]]
+
+            patch_bases = {}
+            if args.nar_patch:
+                print("Finding paths to ship as patches...")
+                with stats.phase("query"):
+                    patch_bases = find_patch_bases(config_closures,
+                        delta_config_closures, ship_path_infos,
+                        query_path_infos)
+
+            dedup_path_infos = []
+            if args.file_dedup:
+                print("Finding duplicate files...")
+                nar_path_infos = {}
+                for p in ship_path_infos:
+                    nar_path_infos.setdefault(p.nar_hash, p)
+                scan_path_infos = list(nar_path_infos.values())
+                with nix_store.NarPrefetcher(nar_store, scan_path_infos,
+                        jobs=args.export_jobs,
+                        buffer_size=args.export_buffer,
+                        direct=args.direct_dump) as prefetcher:
+                    for path_info in scan_path_infos:
+                        with stats.phase("dedup scan",
+                                bytes_in=path_info.nar_size):
+                            prefetcher.source_nar_into(path_info.path,
+                                path_info.nar_size,
+                                lambda nar_fp: sf.scan_nar_for_dedup(
+                                    path_info.nar_hash, nar_fp))
+                dedup_path_infos = [nar_path_infos[h]
+                    for h in sf.finish_dedup_scan()]
 
             sf.write_config_info(config_paths)
 
             sf.write_store_info()
             for p in path_infos:
-                sf.write_narinfo(p, in_file=p.path in paths)
+                sf.write_narinfo(p, in_file=p.path in paths,
+                    patch_base=patch_bases.get(p.nar_hash))
+
+            if len(dedup_path_infos) > 0:
+                print("Writing duplicate files...")
+            for path_info in dedup_path_infos:
+                nar_store.source_nar_into(path_info.path, path_info.nar_size,
+                    lambda nar_fp: sf.sink_dedup_files_from(
+                        path_info.nar_hash, nar_fp))
 
             print("Writing store paths...")
-            for path_info in path_infos:
-                if path_info.path in paths:
-                    store.source_nar_into(path_info.path, path_info.nar_size,
+            # nars in the cache don't need to be exported
+            cached_nars = {p.nar_hash for p in ship_path_infos
+                if p.nar_hash not in patch_bases and
+                    sf.has_cached_nar(p.nar_hash)}
+            export_path_infos = [p for p in ship_path_infos
+                if p.nar_hash not in cached_nars]
+            with nix_store.NarPrefetcher(nar_store, export_path_infos,
+                    jobs=args.export_jobs,
+                    buffer_size=args.export_buffer,
+                    direct=args.direct_dump) as prefetcher:
+                for path_info in ship_path_infos:
+                    base_info = patch_bases.get(path_info.nar_hash)
+                    if base_info is not None:
+                        base_nar = []
+                        nar_store.source_nar_into(base_info.path,
+                            base_info.nar_size,
+                            lambda nar_fp: base_nar.append(
+                                nar_fp.read(base_info.nar_size)))
+                        prefetcher.source_nar_into(path_info.path,
+                            path_info.nar_size,
+                            lambda nar_fp: sf.sink_nar_patch_into(
+                                path_info.nar_hash, path_info.nar_size,
+                                nar_fp, base_nar[0]))
+                        continue
+
+                    if path_info.nar_hash in cached_nars:
+                        if sf.splice_cached_nar(path_info.nar_hash,
+                                path_info.nar_size):
+                            continue
+                        # gone from the cache since we checked, so it wasn't
+                        # prefetched either
+                        nar_source = nar_store
+                    else:
+                        nar_source = prefetcher
+
+                    nar_source.source_nar_into(path_info.path,
+                        path_info.nar_size,
                         lambda nar_fp: sf.sink_nar_into(
                             path_info.nar_hash, path_info.nar_size, nar_fp))
 
         sf.close()
+
+        if cache is not None:
+            cache.evict()
@@ -1,3 +1,4 @@
+import contextlib
 import json
 import subprocess
 import os
@@ -7,6 +8,9 @@ from ..workdir import Workdir
 from .. import nix_tools
 from .. import shipfile
 from .. import nix_store
+from .. import stats
+
+from .common import add_stats_arguments
 
 def build_import_parser(subparsers):
     import argparse
@@ -16,82 +20,206 @@ def build_import_parser(subparsers):
     )
 
     import_parser.add_argument(
-        "src_file", type=str
+        "src_file", type=str,
+        help="shipfile to read, or - for stdin"
     )
 
     import_parser.add_argument("-n", "--name",
-        type=str, help="name of configuration to import",
-        default=open("/proc/sys/kernel/hostname", "r").read().strip()
+        type=str, action="append",
+        help="name of configuration to import (defaults to the hostname); "
+            "may be given more than once, and as NAME=ROOT to import into a "
+            "different root",
     )
 
     import_parser.add_argument("--root",
-        type=str, help="root of system to import configuration into",
-        default=""
+        type=str, action="append",
+        help="root of system to import configurations into (defaults to "
+            "/); may be given more than once to import into several roots",
+    )
+
+    import_parser.add_argument("-j", "--jobs",
+        type=int, help="number of store connections to import with",
+        default=1
     )
 
+    add_stats_arguments(import_parser)
+
     import_parser.set_defaults(handler=import_handler)
     return import_parser
 
+def parse_targets(names, default_roots):
+    # turn the -n and --root arguments into a dict of root -> names of the
+    # configurations to import into it
+    if names is None:
+        names = [open("/proc/sys/kernel/hostname", "r").read().strip()]
+    if default_roots is None:
+        default_roots = [""]
+
+    targets = {}
+    for name in names:
+        name, has_root, root = name.partition("=")
+        for root in ([root] if has_root else default_roots):
+            targets.setdefault(root, [])
+            if name not in targets[root]:
+                targets[root].append(name)
+
+    return targets
+
+class ImportRoot:
+    # a store being imported into and what it needs from the shipfile
+
+    def __init__(self, store_root, store, needed_paths):
+        self.store_root = store_root
+        self.store = store
+        self.needed_paths = needed_paths
+
+        self.base_infos = {} # path -> path info of patch bases in the store
+
+def open_import_roots(stack, sf, targets):
+    # connect to the store of each root and work out what it needs, keeping
+    # the connections open until the stack is closed. paths left over from an
+    # interrupted import are valid and so aren't needed again.
+    roots = []
+    for store_root, names in targets.items():
+        config_paths = [sf.config_info[name] for name in names]
+
+        store = stack.enter_context(nix_store.LocalStore(store_root))
+        needed_paths = compute_needed_paths(config_paths, sf.sorted_path_infos,
+            store, graph=sf.store_graph)
+        roots.append(ImportRoot(store_root, store, needed_paths))
+
+    return roots
+
 # determine which paths we already have and which we need from this file
-def compute_needed_paths(config_path, path_infos, store):
+def compute_needed_paths(config_paths, path_infos, store, graph=None):
     print("Computing the set of paths which need to be imported...")
 
-    # compute the closure of the config path
-    path_info_map = {p.path: p for p in path_infos}
-    check_paths = set([config_path])
-    closure = set()
-    while len(check_paths) > 0:
-        # add the referrers of this path to the ones we need to check
-        path = check_paths.pop()
-        closure.add(path)
+    # compute the closure of the config paths
+    if graph is None:
+        graph = nix_store.StoreGraph(path_infos)
+    closure = graph.closure(config_paths)
 
-        curr_referrers = set(path_info_map[path].references)
-        # remove paths already in the closure i.e. ones we already checked
-        curr_referrers -= closure
-        # remember paths we need to check for more paths in the closure
-        check_paths |= curr_referrers
-
-    valid_path_set = set(store.query_valid_paths(list(closure),
-        lock=True, substitute=False)) # prevent valid paths from being GCd
+    valid_paths = store.query_valid_paths(graph.paths_in(closure),
+        lock=True, substitute=False) # prevent valid paths from being GCd
 
     # return the paths we need but don't have in the correct order
-    needed = closure - valid_path_set
-    return [p.path for p in path_infos if p.path in needed]
+    needed = graph.difference(closure, graph.path_set(valid_paths))
+    return [p.path for p in path_infos if needed[graph.id(p.path)]]
 
-def import_needed_paths(sf, path_list, path_infos, needed_paths, store):
+def check_import_root(sf, path_list, root):
+    # make sure the shipfile has everything the root needs, returning False if
+    # it doesn't
     missing = False
-    for path in needed_paths:
+    for path in root.needed_paths:
         if path not in path_list:
             print(f"error: missing path {path}")
             missing = True
 
     if missing:
-        print("sorry, cannot import")
         return False
 
-    needed_set = set(needed_paths)
-    for path_info in path_infos:
-        if path_info.path not in path_list:
-            continue
-        if path_info.path in needed_set:
-            print("importing", path_info.path)
-            sf.source_nar_into(path_info.nar_hash,
-                lambda fp: store.sink_nar_from(path_info, fp))
+    needed_set = set(root.needed_paths)
+    patch_bases = {sf.nar_patches[p.nar_hash] for p in sf.path_infos
+        if p.path in needed_set and p.nar_hash in sf.nar_patches}
+
+    # make sure we have the right version of every path we need to patch
+    store = root.store
+    base_paths = store.query_valid_paths(sorted(b for b, _ in patch_bases),
+        lock=True, substitute=False) # prevent bases from being GCd
+    root.base_infos = {p.path: p for p in store.query_path_infos(base_paths)}
+    for base_path, base_hash in sorted(patch_bases):
+        base_info = root.base_infos.get(base_path)
+        if base_info is None:
+            print(f"error: missing patch base {base_path}")
+            missing = True
+        elif base_info.nar_hash != base_hash:
+            print(f"error: patch base {base_path} has the wrong contents")
+            missing = True
 
-    return True
+    return not missing
 
-def import_handler(args):
-    with Workdir() as workdir, nix_store.LocalStore(args.root) as store:
-        sf = shipfile.ShipfileReader(workdir/"shipfile", args.src_file)
-        sf.check_version_info()
+def import_needed_paths(sf, roots, jobs=1):
+    # import the paths each root needs, decompressing each nar only once no
+    # matter how many roots need it
+    path_list = set(sf.path_list)
+    can_import = True
+    for root in roots:
+        can_import = check_import_root(sf, path_list, root) and can_import
 
-        sf.read_metadata()
-        sf.read_store_metadata()
+    if not can_import:
+        print("sorry, cannot import")
+        return False
 
-        path_infos = nix_store.sort_path_infos(sf.path_infos)
-        path_list = set(sf.path_list)
+    needed_by = {} # path -> roots which need it
+    for root in roots:
+        for path in root.needed_paths:
+            needed_by.setdefault(path, []).append(root)
+    import_path_infos = [p for p in sf.sorted_path_infos
+        if p.path in path_list and p.path in needed_by]
+
+    # read each patch base out of a root which we checked has it
+    base_roots = {}
+    for root in roots:
+        for base_path in root.base_infos.keys():
+            base_roots.setdefault(base_path, root)
+
+    # decompress the next nars while the store is busy with the current one.
+    # with more than one job, paths whose references are already in the store
+    # are handed to separate store connections to be added concurrently.
+    with contextlib.ExitStack() as stack:
+        if len(base_roots) > 0:
+            # patches are applied on the decompression thread, so it needs
+            # its own connections to read the bases out of the stores
+            base_stores = {}
+            for root in set(base_roots.values()):
+                base_stores[root] = stack.enter_context(
+                    nix_store.LocalStore(root.store_root))
+            def source_base(base_path):
+                root = base_roots[base_path]
+                size = root.base_infos[base_path].nar_size
+                base_nar = []
+                base_stores[root].source_nar_into(base_path, size,
+                    lambda fp: base_nar.append(fp.read(size)))
+                return base_nar[0]
+            sf.set_patch_base_source(source_base)
+
+        nars = stack.enter_context(
+            shipfile.NarReadAhead(sf, import_path_infos))
+        sinks = {}
+        for root in roots:
+            sinks[root] = stack.enter_context(nix_store.NarSinkPool(
+                root.store, root.store_root, jobs=jobs if jobs > 1 else 0))
+
+        if len(roots) == 1:
+            sink = sinks[roots[0]]
+            sink_nar = lambda path_info, fp: sink.sink_nar_from(path_info, fp)
+        else:
+            # feed every root that needs a nar at the same time
+            tee = stack.enter_context(nix_store.NarTee(sinks.values()))
+            sink_nar = lambda path_info, fp: tee.sink_nar_from(path_info, fp,
+                [sinks[root] for root in needed_by[path_info.path]])
+
+        for path_info in import_path_infos:
+            print("importing", path_info.path)
+            nars.source_nar_into(path_info.nar_hash,
+                lambda fp: sink_nar(path_info, fp))
 
-        config_path = sf.config_info[args.name]
-        needed_paths = compute_needed_paths(config_path, path_infos, store)
+    return True
 
-        import_needed_paths(sf, path_list, path_infos, needed_paths, store)
+def import_handler(args):
+    targets = parse_targets(args.name, args.root)
+
+    with stats.collecting("import", args.stats, args.stats_json,
+            args.trace), \
+            Workdir() as workdir, contextlib.ExitStack() as stack:
+        sf = stack.enter_context(
+            shipfile.ShipfileReader(workdir/"shipfile", args.src_file))
+        with stats.phase("read metadata"):
+            sf.check_version_info()
+
+            sf.read_metadata()
+            sf.read_store_metadata()
+
+        with stats.phase("query"):
+            roots = open_import_roots(stack, sf, targets)
+        import_needed_paths(sf, roots, jobs=args.jobs)
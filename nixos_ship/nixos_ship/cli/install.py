@@ -1,3 +1,4 @@
+import contextlib
 import json
 import subprocess
 import os
@@ -6,9 +7,11 @@ from ..workdir import Workdir
 
 from .. import nix_tools
 from .. import shipfile
-from .. import nix_store
+from .. import stats
 
-from .import_cmd import compute_needed_paths, import_needed_paths
+from .common import add_stats_arguments
+
+from .import_cmd import parse_targets, open_import_roots, import_needed_paths
 
 def build_install_parser(subparsers):
     import argparse
@@ -18,67 +21,89 @@ def build_install_parser(subparsers):
     )
 
     install_parser.add_argument(
-        "src_file", type=str
+        "src_file", type=str,
+        help="shipfile to read, or - for stdin"
     )
 
     install_parser.add_argument("-n", "--name",
-        type=str, help="name of configuration to install",
-        default=open("/proc/sys/kernel/hostname", "r").read().strip()
+        type=str, action="append",
+        help="name of configuration to install (defaults to the hostname); "
+            "may be given more than once as NAME=ROOT to install into several "
+            "roots",
     )
 
     install_parser.add_argument("--root",
-        type=str, help="root of system to install configuration into",
-        default=""
+        type=str, action="append",
+        help="root of system to install configuration into (defaults to /); "
+            "may be given more than once to install into several roots",
+    )
+
+    install_parser.add_argument("-j", "--jobs",
+        type=int, help="number of store connections to import with",
+        default=1
     )
 
     install_parser.add_argument("--install-bootloader",
         action="store_true", help="force install system bootloader")
 
+    add_stats_arguments(install_parser)
+
     install_parser.set_defaults(handler=install_handler)
     return install_parser
 
-def install_handler(args):
-    with Workdir() as workdir, nix_store.LocalStore(args.root) as store:
-        sf = shipfile.ShipfileReader(workdir/"shipfile", args.src_file)
-        sf.check_version_info()
+def install_config(store_root, config_path, install_bootloader):
+    nix_tools.set_profile_path(store_root+"/nix/var/nix/profiles/system",
+        config_path, store_root)
+
+    enter_cmd = []
+    if store_root != "":
+        # convince nix tooling this is a nixos partition
+        try:
+            os.mkdir(store_root+"/etc")
+        except FileExistsError:
+            pass
+        open(store_root+"/etc/NIXOS", "w").close()
+
+        subprocess.run([ # from nixos-install, for grub
+            "ln", "-sfn", "/proc/mounts", store_root+"/etc/mtab"
+        ], check=True)
+        enter_cmd = ["nixos-enter", "--root", store_root, "--"]
+
+    env = os.environ.copy()
+    if install_bootloader:
+        env["NIXOS_INSTALL_BOOTLOADER"] = "1"
+
+    subprocess.run([
+        *enter_cmd,
+        config_path+"/bin/switch-to-configuration", "boot"
+    ], check=True, env=env)
 
-        sf.read_metadata()
-        sf.read_store_metadata()
-
-        path_infos = nix_store.sort_path_infos(sf.path_infos)
-        path_list = set(sf.path_list)
-
-        config_path = sf.config_info[args.name]
-        needed_paths = compute_needed_paths(config_path, path_infos, store)
-
-        import_successful = import_needed_paths(
-            sf, path_list, path_infos, needed_paths, store)
+def install_handler(args):
+    targets = parse_targets(args.name, args.root)
+    for store_root, names in targets.items():
+        if len(names) > 1:
+            raise ValueError("can only install one configuration into "
+                f"root {store_root or '/'}")
+
+    with stats.collecting("install", args.stats, args.stats_json,
+            args.trace), \
+            Workdir() as workdir, contextlib.ExitStack() as stack:
+        sf = stack.enter_context(
+            shipfile.ShipfileReader(workdir/"shipfile", args.src_file))
+        with stats.phase("read metadata"):
+            sf.check_version_info()
+
+            sf.read_metadata()
+            sf.read_store_metadata()
+
+        with stats.phase("query"):
+            roots = open_import_roots(stack, sf, targets)
+        import_successful = import_needed_paths(sf, roots, jobs=args.jobs)
 
         if import_successful:
-            nix_tools.set_profile_path(args.root+"/nix/var/nix/profiles/system",
-                config_path, args.root)
-
-            enter_cmd = []
-            if args.root != "":
-                # convince nix tooling this is a nixos partition
-                try:
-                    os.mkdir(args.root+"/etc")
-                except FileExistsError:
-                    pass
-                open(args.root+"/etc/NIXOS", "w").close()
-
-                subprocess.run([ # from nixos-install, for grub
-                    "ln", "-sfn", "/proc/mounts", args.root+"/etc/mtab"
-                ], check=True)
-                enter_cmd = ["nixos-enter", "--root", args.root, "--"]
-
-            env = os.environ.copy()
-            if args.install_bootloader:
-                env["NIXOS_INSTALL_BOOTLOADER"] = "1"
-
-            subprocess.run([
-                *enter_cmd,
-                config_path+"/bin/switch-to-configuration", "boot"
-            ], check=True, env=env)
+            for store_root, names in targets.items():
+                with stats.phase("install"):
+                    install_config(store_root, sf.config_info[names[0]],
+                        args.install_bootloader)
 
             print("install succeeded, please reboot")
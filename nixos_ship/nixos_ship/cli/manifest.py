@@ -0,0 +1,49 @@
+import os
+
+from .. import manifest
+from .. import nix_store
+
+def build_manifest_parser(subparsers):
+    import argparse
+
+    manifest_parser = subparsers.add_parser(
+        "manifest", help="write a manifest of the store paths this system has"
+    )
+
+    manifest_parser.add_argument(
+        "dest_file", type=str
+    )
+
+    manifest_parser.add_argument("--root",
+        type=str, help="root of system whose store paths to list",
+        default=""
+    )
+
+    manifest_parser.add_argument("--bloom",
+        type=float, metavar="RATE",
+        help="write a smaller Bloom filter with the given false positive rate; "
+            "a false positive makes shipfiles created from it uninstallable",
+    )
+
+    manifest_parser.set_defaults(handler=manifest_handler)
+    return manifest_parser
+
+def list_valid_paths(store_root, store):
+    # the store has no way to list everything, so ask about what's on disk
+    candidates = sorted("/nix/store/"+name
+        for name in os.listdir(store_root+"/nix/store")
+        if not name.startswith("."))
+
+    return store.query_valid_paths(candidates, lock=False, substitute=False)
+
+def manifest_handler(args):
+    if args.bloom is not None and not 0 < args.bloom < 1:
+        raise ValueError("--bloom rate must be between 0 and 1")
+
+    with nix_store.LocalStore(args.root) as store:
+        print("Listing valid store paths...")
+        valid_paths = list_valid_paths(args.root, store)
+
+    manifest.write_manifest(args.dest_file, valid_paths,
+        false_positive_rate=args.bloom)
+    print(f"Wrote manifest of {len(valid_paths)} paths")
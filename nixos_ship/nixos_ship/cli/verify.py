@@ -0,0 +1,159 @@
+import hashlib
+import os
+import queue
+import sys
+import tarfile
+import threading
+
+import zstandard
+
+from ..workdir import Workdir
+
+from .. import nar
+from .. import shipfile
+
+def build_verify_parser(subparsers):
+    import argparse
+
+    verify_parser = subparsers.add_parser(
+        "verify", help="check a shipfile is intact without installing it"
+    )
+
+    verify_parser.add_argument(
+        "src_file", type=str,
+        help="shipfile to read, or - for stdin"
+    )
+
+    verify_parser.add_argument("-j", "--jobs",
+        type=int, help="number of threads to hash nars with",
+        default=os.cpu_count() or 1
+    )
+
+    verify_parser.set_defaults(handler=verify_handler)
+    return verify_parser
+
+class NarHasher:
+    # hashes nars on several threads. each nar's data is given to one thread
+    # in order, and nars are spread across the threads.
+
+    def __init__(self, jobs):
+        self._queues = [queue.Queue(maxsize=64) for _ in range(jobs)]
+        self._threads = []
+        self._next_queue = 0
+        self._lock = threading.Lock()
+        self.results = [] # (path_info, digest, size)
+
+    def __enter__(self):
+        for q in self._queues:
+            thread = threading.Thread(target=self._worker, args=(q,),
+                daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        for q in self._queues:
+            q.put(None)
+        for thread in self._threads:
+            thread.join()
+
+    def _worker(self, q):
+        h, size = None, 0
+        while True:
+            item = q.get()
+            if item is None:
+                break
+
+            path_info, data = item
+            if h is None:
+                h, size = hashlib.sha256(), 0
+            if data is not None:
+                h.update(data)
+                size += len(data)
+            else: # end of this nar
+                with self._lock:
+                    self.results.append((path_info, h.digest(), size))
+                h = None
+
+    def hash_nar(self, path_info, fp):
+        q = self._queues[self._next_queue]
+        self._next_queue = (self._next_queue + 1) % len(self._queues)
+
+        while True:
+            data = fp.read(1048576)
+            if len(data) == 0:
+                break
+            q.put((path_info, data))
+        q.put((path_info, None))
+
+def check_closure(sf):
+    # make sure everything referenced in the shipfile is described by it
+    errors = []
+    known = {p.path for p in sf.path_infos}
+
+    for name, config_path in sorted(sf.config_info.items()):
+        if config_path not in known:
+            errors.append(f"config {name} path {config_path} has no narinfo")
+
+    for path_info in sf.path_infos:
+        for reference in path_info.references:
+            if reference not in known:
+                errors.append(f"{path_info.path} references {reference} "
+                    "which has no narinfo")
+
+    return errors
+
+def verify_handler(args):
+    errors = []
+    with Workdir() as workdir, \
+            shipfile.ShipfileReader(workdir/"shipfile", args.src_file) as sf:
+        sf.check_version_info()
+        sf.read_metadata()
+        sf.read_store_metadata()
+
+        print("Checking closure...")
+        errors.extend(check_closure(sf))
+
+        # each distinct nar in the file only needs to be checked once
+        path_list = set(sf.path_list)
+        nar_path_infos = {}
+        for path_info in sf.sorted_path_infos:
+            if path_info.path in path_list:
+                nar_path_infos.setdefault(path_info.nar_hash, path_info)
+        path_infos = list(nar_path_infos.values())
+
+        # patches can't be checked without the base from the store
+        patched = [p for p in path_infos if p.nar_hash in sf.nar_patches]
+        for path_info in patched:
+            print(f"skipping {path_info.path}, it is a patch")
+        path_infos = [p for p in path_infos if p.nar_hash not in sf.nar_patches]
+
+        print(f"Hashing {len(path_infos)} paths...")
+        try:
+            with shipfile.NarReadAhead(sf, path_infos) as nars, \
+                    NarHasher(max(args.jobs, 1)) as hasher:
+                for path_info in path_infos:
+                    nars.source_nar_into(path_info.nar_hash,
+                        lambda fp: hasher.hash_nar(path_info, fp))
+        except (shipfile.ShipfileError, tarfile.TarError,
+                zstandard.ZstdError) as e:
+            errors.append(f"could not read nars: {e}")
+
+        for path_info, digest, size in hasher.results:
+            if size != path_info.nar_size:
+                errors.append(f"{path_info.path} has size {size} but "
+                    f"should be {path_info.nar_size}")
+            elif not nar.nar_hash_matches(path_info.nar_hash, digest):
+                errors.append(f"{path_info.path} has hash "
+                    f"{nar.format_nar_hash(digest)} but should be "
+                    f"{path_info.nar_hash}")
+
+    for error in errors:
+        print(f"error: {error}")
+
+    if len(errors) > 0:
+        print("shipfile is damaged")
+        sys.exit(1)
+
+    print(f"verified {len(path_infos)} paths")
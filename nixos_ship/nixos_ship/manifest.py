@@ -0,0 +1,136 @@
+# functions for reading and writing manifests of the store paths a system has.
+#
+# a manifest starts with a header of the magic "shfmnfst", a little-endian u32
+# version (currently 1), a u32 kind, and a u64 count of paths. each path is
+# identified by the SHA-256 hash of its full store path. for kind 0, the header
+# is followed by the first 8 bytes of each path's hash as little-endian u64s in
+# ascending order. for kind 1, it is followed by a u32 number of hash functions
+# k, 4 bytes of padding, a u64 number of bits m, and then a Bloom filter of m
+# bits (padded to a whole byte) where the bits for each path are
+# (h1 + i*h2) mod m for i in 0..k-1, with h1 and h2 the first and second 8
+# bytes of the path's hash as little-endian u64s.
+
+import hashlib
+import math
+import struct
+
+MANIFEST_MAGIC = b"shfmnfst"
+MANIFEST_VERSION = 1
+MANIFEST_HEADER_FORMAT = "<8sIIQ"
+BLOOM_HEADER_FORMAT = "<IxxxxQ"
+
+KIND_EXACT = 0
+KIND_BLOOM = 1
+
+# something went wrong reading a manifest
+class ManifestError(RuntimeError):
+    pass
+
+def _path_hashes(path):
+    digest = hashlib.sha256(path.encode("utf8")).digest()
+    return struct.unpack("<QQ", digest[:16])
+
+class ExactManifest:
+    def __init__(self, hashes):
+        self._hashes = set(hashes)
+
+    def __contains__(self, path):
+        return _path_hashes(path)[0] in self._hashes
+
+    def __len__(self):
+        return len(self._hashes)
+
+    @classmethod
+    def from_paths(cls, paths):
+        return cls(_path_hashes(p)[0] for p in paths)
+
+    def dump(self):
+        hashes = sorted(self._hashes)
+        return (struct.pack(MANIFEST_HEADER_FORMAT, MANIFEST_MAGIC,
+            MANIFEST_VERSION, KIND_EXACT, len(hashes))
+            +struct.pack(f"<{len(hashes)}Q", *hashes))
+
+class BloomManifest:
+    def __init__(self, count, num_hashes, num_bits, bits):
+        self._count = count
+        self._num_hashes = num_hashes
+        self._num_bits = num_bits
+        self._bits = bits
+
+    def __contains__(self, path):
+        h1, h2 = _path_hashes(path)
+        for i in range(self._num_hashes):
+            bit = (h1 + i*h2) % self._num_bits
+            if not self._bits[bit >> 3] & (1 << (bit & 7)):
+                return False
+        return True
+
+    def __len__(self):
+        return self._count
+
+    @classmethod
+    def from_paths(cls, paths, false_positive_rate):
+        paths = list(paths)
+        count = max(len(paths), 1)
+        num_bits = math.ceil(
+            -count*math.log(false_positive_rate)/(math.log(2)**2))
+        num_hashes = max(1, round(num_bits/count*math.log(2)))
+
+        manifest = cls(len(paths), num_hashes, num_bits,
+            bytearray((num_bits+7)//8))
+        for path in paths:
+            h1, h2 = _path_hashes(path)
+            for i in range(num_hashes):
+                bit = (h1 + i*h2) % num_bits
+                manifest._bits[bit >> 3] |= 1 << (bit & 7)
+
+        return manifest
+
+    def dump(self):
+        return (struct.pack(MANIFEST_HEADER_FORMAT, MANIFEST_MAGIC,
+            MANIFEST_VERSION, KIND_BLOOM, self._count)
+            +struct.pack(BLOOM_HEADER_FORMAT, self._num_hashes, self._num_bits)
+            +bytes(self._bits))
+
+def load_manifest(data):
+    header_size = struct.calcsize(MANIFEST_HEADER_FORMAT)
+    if len(data) < header_size:
+        raise ManifestError("manifest is truncated")
+
+    magic, version, kind, count = struct.unpack_from(
+        MANIFEST_HEADER_FORMAT, data)
+    if magic != MANIFEST_MAGIC:
+        raise ManifestError("not a manifest")
+    if version != MANIFEST_VERSION:
+        raise ManifestError(f"unknown manifest version {version}")
+
+    if kind == KIND_EXACT:
+        if len(data) != header_size + 8*count:
+            raise ManifestError("manifest has the wrong size")
+        return ExactManifest(struct.unpack_from(f"<{count}Q", data,
+            header_size))
+    elif kind == KIND_BLOOM:
+        bloom_size = struct.calcsize(BLOOM_HEADER_FORMAT)
+        if len(data) < header_size + bloom_size:
+            raise ManifestError("manifest is truncated")
+        num_hashes, num_bits = struct.unpack_from(BLOOM_HEADER_FORMAT, data,
+            header_size)
+        bits = data[header_size+bloom_size:]
+        if num_bits == 0 or len(bits) != (num_bits+7)//8:
+            raise ManifestError("manifest has the wrong size")
+        return BloomManifest(count, num_hashes, num_bits, bits)
+    else:
+        raise ManifestError(f"unknown manifest kind {kind}")
+
+def read_manifest(path):
+    with open(path, "rb") as f:
+        return load_manifest(f.read())
+
+def write_manifest(path, store_paths, false_positive_rate=None):
+    if false_positive_rate is None:
+        manifest = ExactManifest.from_paths(store_paths)
+    else:
+        manifest = BloomManifest.from_paths(store_paths, false_positive_rate)
+
+    with open(path, "wb") as f:
+        f.write(manifest.dump())
@@ -0,0 +1,210 @@
+# functions for working with the nar format
+
+import io
+import os
+import stat
+import struct
+
+NAR_MAGIC = b"nix-archive-1"
+
+# something went wrong parsing a nar
+class NarError(RuntimeError):
+    pass
+
+def read_exact(fp, length):
+    data = fp.read(length)
+    if len(data) != length:
+        raise NarError("nar is truncated")
+    return data
+
+class NarParser:
+    # parses a nar as it streams out of fp. literal_fn is called with all the
+    # bytes of the nar which are not regular file contents, in order. for each
+    # regular file, contents_fn is called with its size and fp, and must read
+    # exactly that many bytes of contents out of fp.
+
+    def __init__(self, fp, literal_fn, contents_fn):
+        self._fp = fp
+        self._literal_fn = literal_fn
+        self._contents_fn = contents_fn
+
+    def parse(self):
+        self._expect(NAR_MAGIC)
+        self._parse_node()
+
+    def _read(self, length):
+        data = read_exact(self._fp, length)
+        self._literal_fn(data)
+        return data
+
+    def _read_num(self):
+        return struct.unpack("<Q", self._read(8))[0]
+
+    def _read_string(self):
+        length = self._read_num()
+        data = self._read(length)
+        if length % 8 > 0:
+            if self._read(8-(length%8)).strip(b"\x00") != b"":
+                raise NarError("nar string padding is not zero")
+        return data
+
+    def _expect(self, expected):
+        got = self._read_string()
+        if got != expected:
+            raise NarError(f"expected {expected!r} in nar but got {got!r}")
+
+    def _parse_node(self):
+        self._expect(b"(")
+        self._expect(b"type")
+        node_type = self._read_string()
+
+        if node_type == b"regular":
+            tag = self._read_string()
+            if tag == b"executable":
+                self._expect(b"")
+                tag = self._read_string()
+            if tag != b"contents":
+                raise NarError(f"unexpected {tag!r} in nar regular file")
+
+            size = self._read_num()
+            self._contents_fn(size, self._fp)
+            if size % 8 > 0:
+                self._read(8-(size%8))
+            self._expect(b")")
+        elif node_type == b"symlink":
+            self._expect(b"target")
+            self._read_string()
+            self._expect(b")")
+        elif node_type == b"directory":
+            while True:
+                tag = self._read_string()
+                if tag == b")":
+                    break
+                if tag != b"entry":
+                    raise NarError(f"unexpected {tag!r} in nar directory")
+                self._expect(b"(")
+                self._expect(b"name")
+                self._read_string()
+                self._expect(b"node")
+                self._parse_node()
+                self._expect(b")")
+        else:
+            raise NarError(f"unknown nar node type {node_type!r}")
+
+def _nar_string(data):
+    return b"".join((struct.pack("<Q", len(data)), data,
+        b"\x00"*(-len(data)%8)))
+
+def _nar_strings(*strings):
+    return b"".join(_nar_string(s) for s in strings)
+
+# how much of a file to read at once when dumping it
+DUMP_CHUNK_SIZE = 1048576
+
+def dump_nar(path):
+    # serialize the file, symlink or directory at path to a nar, yielding it in
+    # pieces. the output is byte for byte what nix-store --dump gives. a yielded
+    # piece may be reused for the next one, so it must be used up before then.
+    yield _nar_string(NAR_MAGIC)
+    yield from _dump_node(os.fsencode(path), bytearray(DUMP_CHUNK_SIZE))
+
+def _dump_node(path, buf):
+    st = os.lstat(path)
+    if stat.S_ISREG(st.st_mode):
+        header = [b"(", b"type", b"regular"]
+        if st.st_mode & stat.S_IXUSR:
+            header.extend((b"executable", b""))
+        header.append(b"contents")
+        yield _nar_strings(*header) + struct.pack("<Q", st.st_size)
+
+        size = 0
+        with open(path, "rb", buffering=0) as f:
+            view = memoryview(buf)
+            while True:
+                num_read = f.readinto(view)
+                if num_read == 0:
+                    break
+                size += num_read
+                yield view[:num_read]
+        if size != st.st_size:
+            raise NarError(f"{os.fsdecode(path)} changed while dumping it")
+
+        yield b"\x00"*(-size%8) + _nar_string(b")")
+    elif stat.S_ISLNK(st.st_mode):
+        yield _nar_strings(b"(", b"type", b"symlink", b"target",
+            os.readlink(path), b")")
+    elif stat.S_ISDIR(st.st_mode):
+        yield _nar_strings(b"(", b"type", b"directory")
+        # nix sorts the entries by their raw bytes
+        for name in sorted(os.listdir(path)):
+            yield _nar_strings(b"entry", b"(", b"name", name, b"node")
+            yield from _dump_node(os.path.join(path, name), buf)
+            yield _nar_string(b")")
+        yield _nar_string(b")")
+    else:
+        raise NarError(f"can't put {os.fsdecode(path)} in a nar as it is not "
+            "a file, symlink or directory")
+
+class _NarDumpRaw(io.RawIOBase):
+    def __init__(self, path):
+        self._pieces = dump_nar(path)
+        self._piece = memoryview(b"")
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        # fill as much of b as we can so lots of little pieces don't each cost
+        # a call
+        b = memoryview(b).cast("B")
+        pos = 0
+        while pos < len(b):
+            if len(self._piece) == 0:
+                piece = next(self._pieces, None)
+                if piece is None:
+                    break
+                self._piece = memoryview(piece).cast("B")
+                continue
+
+            size = min(len(b)-pos, len(self._piece))
+            b[pos:pos+size] = self._piece[:size]
+            self._piece = self._piece[size:]
+            pos += size
+
+        return pos
+
+    def close(self):
+        self._piece = memoryview(b"")
+        self._pieces.close()
+        super().close()
+
+def open_nar_dump(path):
+    # a file object to read the nar of path out of, as dump_nar makes it
+    return io.BufferedReader(_NarDumpRaw(path), DUMP_CHUNK_SIZE)
+
+NIX_BASE32_CHARS = "0123456789abcdfghijklmnpqrsvwxyz"
+
+def nix_base32_encode(digest):
+    # encode bytes in nix's peculiar base32, as used in store paths and hashes
+    length = (len(digest)*8 + 4) // 5
+    chars = []
+    for n in range(length-1, -1, -1):
+        b = n*5
+        i, j = divmod(b, 8)
+        c = digest[i] >> j
+        if i+1 < len(digest):
+            c |= digest[i+1] << (8-j)
+        chars.append(NIX_BASE32_CHARS[c & 0x1f])
+    return "".join(chars)
+
+def format_nar_hash(digest):
+    return "sha256:"+nix_base32_encode(digest)
+
+def nar_hash_matches(nar_hash, digest):
+    # check a sha256 nar hash in either base32 or base16 form against a digest
+    algo, _, encoded = nar_hash.partition(":")
+    if algo != "sha256":
+        return False
+    if len(encoded) == 64:
+        return encoded.lower() == digest.hex()
+    return encoded == nix_base32_encode(digest)
@@ -0,0 +1,117 @@
+# a cache of compressed nar members which persists between shipfile creations.
+#
+# each entry holds the independent zstd frame of one nar's tar member (header,
+# data, and padding) as written into a seekable shipfile, preceded by the
+# uncompressed size of the member as a little-endian u64. entries are stored as
+# <cache dir>/<compression level>/<nar hash>.zst and are evicted least recently
+# used first once the cache is over its maximum size. entries are written to
+# temporary files next to them first, which count towards the size too.
+
+import os
+import pathlib
+import struct
+import tempfile
+import time
+
+CACHE_ENTRY_HEADER_FORMAT = "<Q"
+CACHE_ENTRY_HEADER_SIZE = struct.calcsize(CACHE_ENTRY_HEADER_FORMAT)
+
+# a temporary file which hasn't been written to in this many seconds was left
+# behind by a creation which was killed rather than one still writing it
+STALE_TEMP_AGE = 3600
+
+class NarCache:
+    def __init__(self, path, max_size):
+        self._path = pathlib.Path(path)
+        self._max_size = max_size
+
+        self._path.mkdir(parents=True, exist_ok=True)
+
+    def _entry_path(self, compression, nar_hash):
+        return self._path/compression/f"{nar_hash.split(':')[1]}.zst"
+
+    def contains(self, compression, nar_hash):
+        return self._entry_path(compression, nar_hash).is_file()
+
+    def open(self, compression, nar_hash):
+        # return the member size and an fp to read the frame out of, or None
+        # if the entry is not in the cache
+        entry_path = self._entry_path(compression, nar_hash)
+        try:
+            fp = open(entry_path, "rb")
+        except FileNotFoundError:
+            return None
+
+        # remember it was used recently
+        os.utime(fp.fileno())
+
+        member_size = struct.unpack(CACHE_ENTRY_HEADER_FORMAT,
+            fp.read(CACHE_ENTRY_HEADER_SIZE))[0]
+        return member_size, fp
+
+    def add(self, compression, nar_hash):
+        # return a writer which puts an entry in the cache once it is
+        # committed
+        entry_path = self._entry_path(compression, nar_hash)
+        entry_path.parent.mkdir(exist_ok=True)
+
+        return CacheEntryWriter(entry_path)
+
+    def evict(self):
+        # remove the least recently used entries until the cache is small
+        # enough, along with any stale temporary files
+        entries = []
+        total_size = 0
+        now = time.time()
+        for temp_path in self._path.glob("*/.*.tmp"):
+            try:
+                st = temp_path.stat()
+                if now - st.st_mtime > STALE_TEMP_AGE:
+                    temp_path.unlink()
+                    continue
+            except FileNotFoundError: # committed or aborted meanwhile
+                continue
+            # will be an entry soon, but can't be evicted yet
+            total_size += st.st_size
+
+        for entry_path in self._path.glob("*/*.zst"):
+            try:
+                st = entry_path.stat()
+            except FileNotFoundError: # someone else evicted it
+                continue
+            entries.append((st.st_mtime, entry_path, st.st_size))
+            total_size += st.st_size
+
+        entries.sort()
+        for _, entry_path, size in entries:
+            if total_size <= self._max_size:
+                break
+            try:
+                entry_path.unlink()
+            except FileNotFoundError:
+                pass
+            total_size -= size
+
+class CacheEntryWriter:
+    def __init__(self, entry_path):
+        self._entry_path = entry_path
+
+        # write to a temporary file so a partial entry is never seen
+        fd, temp_path = tempfile.mkstemp(dir=entry_path.parent,
+            prefix=".", suffix=".tmp")
+        self._temp_path = pathlib.Path(temp_path)
+        self._file = os.fdopen(fd, "wb")
+        self._file.write(b"\x00"*CACHE_ENTRY_HEADER_SIZE)
+
+    def write(self, data):
+        return self._file.write(data)
+
+    def commit(self, member_size):
+        self._file.seek(0)
+        self._file.write(struct.pack(CACHE_ENTRY_HEADER_FORMAT, member_size))
+        self._file.close()
+        os.rename(self._temp_path, self._entry_path)
+
+    def abort(self):
+        self._file.close()
+        self._temp_path.unlink()
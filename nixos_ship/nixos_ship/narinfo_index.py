@@ -0,0 +1,150 @@
+# functions for reading and writing the narinfo index, which holds everything
+# in a shipfile's .narinfo files in a single compact member.
+#
+# the index starts with a header of the magic "shfnrinf", then little-endian
+# u32s for the version (currently 1), the number of strings, the number of
+# paths, the total number of references, the total number of signatures and
+# the total number of deduplicated files, then a u64 number of bytes of
+# .narinfo members which follow the index in the archive. next is a u32 length
+# for each string, followed by the UTF-8 data of all the strings back to back.
+# string 0 is always empty. after that is a record for each path with u32 string ids of its
+# store path, deriver, URL, NAR hash, CA, patch base path and patch base hash,
+# then its u64 NAR size, u32 number of references, u32 number of signatures and
+# u32 number of deduplicated files. last are the references of all the paths in
+# order as u32 ids of the records they refer to, then the signatures of all the
+# paths in order as u32 string ids, then the deduplicated files of all the
+# paths in order as u32 string ids.
+
+import struct
+
+from .nix_store import PathInfo
+
+NARINFO_INDEX_MAGIC = b"shfnrinf"
+NARINFO_INDEX_VERSION = 1
+NARINFO_INDEX_HEADER_FORMAT = "<8sIIIIIIQ"
+NARINFO_INDEX_RECORD_FORMAT = "<IIIIIIIQIII"
+
+# something went wrong reading or writing a narinfo index
+class NarinfoIndexError(RuntimeError):
+    pass
+
+def dump_narinfo_index(entries, narinfo_size):
+    # entries is a list of (path_info, url, patch_base, dedup_files) for each
+    # .narinfo, in order, where patch_base is (base path, base nar hash) or
+    # None and dedup_files is a list of the hashes of the deduplicated files
+    # its nar uses.
+    # narinfo_size is the number of archive bytes the .narinfo members take.
+
+    strings = [""]
+    string_ids = {"": 0}
+    def string_id(s):
+        sid = string_ids.get(s)
+        if sid is None:
+            sid = string_ids[s] = len(strings)
+            strings.append(s)
+        return sid
+
+    path_ids = {p.path: i for i, (p, _, _, _) in enumerate(entries)}
+
+    records = []
+    refs = []
+    sigs = []
+    files = []
+    for path_info, url, patch_base, dedup_files in entries:
+        base_path, base_hash = patch_base or ("", "")
+        records.append((string_id(path_info.path),
+            string_id(path_info.deriver), string_id(url),
+            string_id(path_info.nar_hash), string_id(path_info.ca_info),
+            string_id(base_path), string_id(base_hash),
+            path_info.nar_size, len(path_info.references),
+            len(path_info.sigs), len(dedup_files)))
+        for reference in path_info.references:
+            try:
+                refs.append(path_ids[reference])
+            except KeyError:
+                raise NarinfoIndexError(f"{path_info.path} references "
+                    f"{reference} which has no narinfo") from None
+        sigs.extend(string_id(s) for s in path_info.sigs)
+        files.extend(string_id(f) for f in dedup_files)
+
+    encoded = [s.encode("utf8") for s in strings]
+    return b"".join([
+        struct.pack(NARINFO_INDEX_HEADER_FORMAT, NARINFO_INDEX_MAGIC,
+            NARINFO_INDEX_VERSION, len(strings), len(records), len(refs),
+            len(sigs), len(files), narinfo_size),
+        struct.pack(f"<{len(encoded)}I", *(len(s) for s in encoded)),
+        *encoded,
+        *(struct.pack(NARINFO_INDEX_RECORD_FORMAT, *r) for r in records),
+        struct.pack(f"<{len(refs)}I", *refs),
+        struct.pack(f"<{len(sigs)}I", *sigs),
+        struct.pack(f"<{len(files)}I", *files),
+    ])
+
+def load_narinfo_index(data):
+    # return the entries and narinfo_size given to dump_narinfo_index
+
+    data = memoryview(data)
+    try:
+        (magic, version, num_strings, num_paths, num_refs, num_sigs,
+            num_files, narinfo_size) = struct.unpack_from(
+                NARINFO_INDEX_HEADER_FORMAT, data)
+        if magic != NARINFO_INDEX_MAGIC:
+            raise NarinfoIndexError("not a narinfo index")
+        if version != NARINFO_INDEX_VERSION:
+            raise NarinfoIndexError(f"unknown narinfo index version {version}")
+        pos = struct.calcsize(NARINFO_INDEX_HEADER_FORMAT)
+
+        lengths = struct.unpack_from(f"<{num_strings}I", data, pos)
+        pos += 4*num_strings
+        strings = []
+        for length in lengths:
+            strings.append(str(data[pos:pos+length], "utf8"))
+            pos += length
+
+        record_size = struct.calcsize(NARINFO_INDEX_RECORD_FORMAT)
+        records = list(struct.iter_unpack(NARINFO_INDEX_RECORD_FORMAT,
+            data[pos:pos+record_size*num_paths]))
+        if len(records) != num_paths:
+            raise NarinfoIndexError("narinfo index is truncated")
+        pos += record_size*num_paths
+        refs = struct.unpack_from(f"<{num_refs}I", data, pos)
+        pos += 4*num_refs
+        sigs = struct.unpack_from(f"<{num_sigs}I", data, pos)
+        pos += 4*num_sigs
+        files = struct.unpack_from(f"<{num_files}I", data, pos)
+        pos += 4*num_files
+        if pos != len(data):
+            raise NarinfoIndexError("narinfo index has the wrong size")
+
+        # references can point anywhere, even at the path itself
+        paths = [strings[r[0]] for r in records]
+        entries = []
+        ref_pos = 0
+        sig_pos = 0
+        file_pos = 0
+        for (path, deriver, url, nar_hash, ca_info, base_path, base_hash,
+                nar_size, path_refs, path_sigs, path_files) in records:
+            path_info = PathInfo(path=strings[path],
+                deriver=strings[deriver],
+                references=[paths[r]
+                    for r in refs[ref_pos:ref_pos+path_refs]],
+                nar_size=nar_size,
+                nar_hash=strings[nar_hash],
+                ca_info=strings[ca_info],
+                sigs=[strings[s] for s in sigs[sig_pos:sig_pos+path_sigs]],
+            )
+            dedup_files = [strings[f]
+                for f in files[file_pos:file_pos+path_files]]
+            ref_pos += path_refs
+            sig_pos += path_sigs
+            file_pos += path_files
+
+            patch_base = None
+            if base_path != 0:
+                patch_base = (strings[base_path], strings[base_hash])
+
+            entries.append((path_info, strings[url], patch_base, dedup_files))
+    except (struct.error, IndexError, UnicodeDecodeError) as e:
+        raise NarinfoIndexError("narinfo index is corrupt") from e
+
+    return entries, narinfo_size
@@ -0,0 +1,164 @@
+# answers store metadata queries by reading nix's SQLite database directly
+# instead of going through nix-store --serve, which walks closures one path at
+# a time and sends every field back as its own padded string.
+#
+# the database is only ever opened read-only. it is usually only readable by
+# root, and its schema isn't promised to stay the same, so whenever it can't be
+# opened or a query on it fails, the query is given to the store instead.
+
+import json
+import sqlite3
+
+from .nar import nix_base32_encode
+from .nix_store import PathInfo, sort_paths
+
+NIX_DB_PATH = "/nix/var/nix/db/db.sqlite"
+
+# the closure of the paths in the JSON list parameter, as ValidPaths ids
+_CLOSURE_CTE = """
+    WITH RECURSIVE closure(id) AS (
+        SELECT id FROM ValidPaths
+            WHERE path IN (SELECT value FROM json_each(?))
+        UNION
+        SELECT Refs.reference FROM Refs
+            JOIN closure ON Refs.referrer = closure.id
+    )
+"""
+
+class StoreMetadataBackend:
+    def __init__(self, store, db_path=NIX_DB_PATH):
+        # store is the StoreCommunicator to fall back to
+        self._store = store
+        self._db = None
+
+        try:
+            db = sqlite3.connect(f"file:{db_path}?mode=ro", uri=True,
+                isolation_level=None)
+        except sqlite3.Error:
+            return
+        try:
+            # make sure we can actually read what we need
+            db.execute("SELECT id, path, hash, deriver, narSize, sigs, ca "
+                "FROM ValidPaths LIMIT 1").fetchall()
+            db.execute("SELECT referrer, reference FROM Refs "
+                "LIMIT 1").fetchall()
+        except sqlite3.Error:
+            db.close()
+            return
+
+        self._db = db
+
+    @property
+    def using_db(self):
+        return self._db is not None
+
+    def close(self):
+        if self._db is not None:
+            self._db.close()
+            self._db = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def _query(self, query_fn, fallback_fn):
+        # run query_fn on the database in one read transaction so it sees a
+        # consistent store, or fallback_fn if that can't be done. query_fn
+        # returns None if the store should answer instead.
+        if self._db is None:
+            return fallback_fn()
+
+        try:
+            self._db.execute("BEGIN")
+            try:
+                result = query_fn(self._db)
+            finally:
+                self._db.execute("ROLLBACK")
+        except sqlite3.Error:
+            result = None
+
+        if result is None:
+            return fallback_fn()
+        return result
+
+    def query_valid_paths(self, paths, lock=True, substitute=False):
+        if substitute: # only the store knows how to substitute
+            return self._store.query_valid_paths(paths, lock, substitute)
+
+        def query(db):
+            rows = db.execute("SELECT path FROM ValidPaths "
+                "WHERE path IN (SELECT value FROM json_each(?))",
+                (json.dumps(list(paths)),))
+            return sorted(path for path, in rows)
+
+        return self._query(query,
+            lambda: self._store.query_valid_paths(paths, lock, substitute))
+
+    def query_closure(self, paths, include_outputs=False):
+        return self.query_closures([paths], include_outputs)[0]
+
+    def query_closures(self, path_lists, include_outputs=False):
+        if include_outputs: # needs the derivations parsed
+            return self._store.query_closures(path_lists, include_outputs)
+
+        def query(db):
+            closures = []
+            for paths in path_lists:
+                paths = set(paths)
+                paths_json = json.dumps(sorted(paths))
+                # the store refuses to give closures of invalid paths, so let
+                # it say what's wrong
+                num_valid = db.execute("SELECT count(*) FROM ValidPaths "
+                    "WHERE path IN (SELECT value FROM json_each(?))",
+                    (paths_json,)).fetchone()[0]
+                if num_valid != len(paths):
+                    return None
+
+                rows = db.execute(_CLOSURE_CTE+"SELECT path FROM ValidPaths "
+                    "JOIN closure USING (id)", (paths_json,))
+                closures.append(sorted(path for path, in rows))
+            return closures
+
+        return self._query(query,
+            lambda: self._store.query_closures(path_lists, include_outputs))
+
+    def query_path_infos(self, paths):
+        def query(db):
+            paths_json = json.dumps(list(paths))
+            references = {}
+            rows = db.execute("SELECT Refs.referrer, ValidPaths.path "
+                "FROM Refs JOIN ValidPaths ON ValidPaths.id = Refs.reference "
+                "WHERE Refs.referrer IN (SELECT id FROM ValidPaths "
+                    "WHERE path IN (SELECT value FROM json_each(?)))",
+                (paths_json,))
+            for referrer, reference in rows:
+                references.setdefault(referrer, []).append(reference)
+
+            path_infos = []
+            rows = db.execute("SELECT id, path, hash, deriver, narSize, sigs, "
+                "ca FROM ValidPaths "
+                "WHERE path IN (SELECT value FROM json_each(?)) ORDER BY path",
+                (paths_json,))
+            for path_id, path, nar_hash, deriver, nar_size, sigs, ca in rows:
+                path_infos.append(PathInfo(
+                    path=path,
+                    deriver=deriver or "",
+                    references=sort_paths(references.get(path_id, [])),
+                    nar_size=nar_size or 0,
+                    nar_hash=_format_db_hash(nar_hash),
+                    ca_info=ca or "",
+                    sigs=sorted((sigs or "").split()),
+                ))
+            return path_infos
+
+        return self._query(query, lambda: self._store.query_path_infos(paths))
+
+def _format_db_hash(db_hash):
+    # the database has the hash in base16 but the store gives it in base32
+    algo, _, encoded = db_hash.partition(":")
+    try:
+        return f"{algo}:{nix_base32_encode(bytes.fromhex(encoded))}"
+    except ValueError:
+        return db_hash
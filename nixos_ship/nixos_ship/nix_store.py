@@ -1,14 +1,26 @@
 from enum import IntEnum
 from dataclasses import dataclass, asdict
 from typing import Optional
+from array import array
+import itertools
 import subprocess
+import threading
 import struct
+import queue
+import io
+
+from .nar import NarError, open_nar_dump
+from . import stats
 
 SERVE_MAGIC_1 = 0x390c9deb
 SERVE_MAGIC_2 = 0x5452eecb
 
 PROTOCOL_VERSION = (2 << 8) | 7
 
+_pack_num = struct.Struct("<Q").pack
+# padding to bring a string of each length mod 8 up to a multiple of 8
+_PADDING = [b"\x00"*((8-n)%8) for n in range(8)]
+
 class ServeCommand(IntEnum):
     QUERY_VALID_PATHS = 1
     QUERY_PATH_INFOS = 2
@@ -37,27 +49,120 @@ def sort_paths(paths):
     # first sort by name, then hash
     return sorted(paths, key=lambda p: (p[44:], p[:43]))
 
-# sort path infos into topological order
-def sort_path_infos(path_infos):
-    paths = sort_paths(p.path for p in path_infos)
-    path_info_map = {p.path: p for p in path_infos}
-
-    sorted_path_infos = []
-    seen_paths = set()
-    def dfs(path_info):
-        if path_info.path in seen_paths:
-            return
-        seen_paths.add(path_info.path)
-
-        for reference in path_info.references:
-            dfs(path_info_map[reference])
-
-        sorted_path_infos.append(path_info)
-
-    for path in paths:
-        dfs(path_info_map[path])
-
-    return sorted_path_infos
+# sort path infos into topological order. a StoreGraph of the path infos can be
+# given if there already is one.
+def sort_path_infos(path_infos, graph=None):
+    if graph is None:
+        graph = StoreGraph(path_infos)
+    return [graph.path_infos[i] for i in graph.topo_order()]
+
+# swaps 0 and 1 bytes to invert a path set
+_INVERT_PATH_SET = bytes([1, 0])+bytes(range(2, 256))
+
+class StoreGraph:
+    # the paths of a closure and the references between them, compact enough
+    # for hundreds of thousands of paths. each path gets an integer id, in the
+    # order of sort_paths, and the references of every path are stored back to
+    # back in one array with another array saying where each path's references
+    # begin.
+    # sets of paths are bytearrays with a 1 at the id of each path in the set,
+    # so they can be combined all at once.
+
+    def __init__(self, path_infos):
+        path_infos = list(path_infos)
+        self.paths = sort_paths(p.path for p in path_infos)
+        self._ids = {path: i for i, path in enumerate(self.paths)}
+
+        path_info_map = {p.path: p for p in path_infos}
+        self.path_infos = [path_info_map[path] for path in self.paths]
+
+        self._ref_starts = array("L", [0])
+        self._refs = array("L")
+        for path_info in self.path_infos:
+            self._refs.extend(self._ids[r] for r in path_info.references)
+            self._ref_starts.append(len(self._refs))
+
+    def __len__(self):
+        return len(self.paths)
+
+    def id(self, path):
+        return self._ids[path]
+
+    def references(self, path_id):
+        return self._refs[self._ref_starts[path_id]:self._ref_starts[path_id+1]]
+
+    def path_set(self, paths):
+        # make a set of the given paths, leaving out any not in the graph
+        path_set = bytearray(len(self.paths))
+        for path in paths:
+            path_id = self._ids.get(path)
+            if path_id is not None:
+                path_set[path_id] = 1
+        return path_set
+
+    def paths_in(self, path_set):
+        # list the paths in a set, in id order
+        return list(itertools.compress(self.paths, path_set))
+
+    def closure(self, paths):
+        # the set of the given paths and everything they reference
+        path_set = bytearray(len(self.paths))
+        refs, starts = self._refs, self._ref_starts
+        stack = [self._ids[path] for path in paths]
+        while len(stack) > 0:
+            path_id = stack.pop()
+            if path_set[path_id]:
+                continue
+            path_set[path_id] = 1
+            stack.extend(refs[starts[path_id]:starts[path_id+1]])
+        return path_set
+
+    def union(self, *path_sets):
+        result = 0
+        for path_set in path_sets:
+            result |= int.from_bytes(path_set, "little")
+        return bytearray(result.to_bytes(len(self.paths), "little"))
+
+    def difference(self, path_set, other):
+        result = int.from_bytes(path_set, "little") & \
+            ~int.from_bytes(other, "little")
+        return bytearray(result.to_bytes(len(self.paths), "little"))
+
+    def topo_order(self, path_set=None):
+        # list the ids of the paths in the set (or all of them) so that each
+        # path comes after the ones it references. starting from each path in
+        # id order, this visits references depth first and lists a path once
+        # they are all listed, so it's deterministic and keeps similarly named
+        # paths together. references outside the set are ignored.
+        if path_set is None:
+            seen = bytearray(len(self.paths))
+        else: # pretend the paths outside the set were already listed
+            seen = bytearray(bytes(path_set).translate(_INVERT_PATH_SET))
+
+        order = []
+        refs, starts = self._refs, self._ref_starts
+        for root in range(len(self.paths)):
+            if seen[root]:
+                continue
+            seen[root] = 1
+
+            # stack of (path id, position in refs of the next one to visit)
+            stack = [(root, starts[root])]
+            while len(stack) > 0:
+                path_id, pos = stack[-1]
+                end = starts[path_id+1]
+                while pos < end and seen[refs[pos]]:
+                    pos += 1
+                if pos == end: # all references are listed
+                    stack.pop()
+                    order.append(path_id)
+                else:
+                    stack[-1] = (path_id, pos+1)
+                    ref_id = refs[pos]
+                    seen[ref_id] = 1
+                    stack.append((ref_id, starts[ref_id]))
+
+        return order
 
 class LocalStore:
     def __init__(self, store_root=""):
@@ -87,6 +192,438 @@ class LocalStore:
     def __exit__(self, exc_type, exc_val, exc_tb):
         self._close()
 
+class DirectNarSource:
+    # stands in for a store connection when exporting nars, but dumps them
+    # straight out of the store directory instead of asking nix-store. this
+    # saves a trip through another process and lets any number of threads dump
+    # at once. the nars have to match what the store recorded, which they do
+    # as long as nobody has been tampering with the store.
+
+    def __init__(self, store_root=""):
+        self._store_root = store_root
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        pass
+
+    def source_nar_into(self, path, size, nar_sink_fn):
+        # same as StoreCommunicator.source_nar_into
+        with open_nar_dump(self._store_root+path) as fp:
+            nar_sink_fn(fp)
+            # the sink reads exactly size bytes, so anything left over means
+            # the nar isn't the one the store knows about
+            if len(fp.read(1)) > 0:
+                raise NarError(f"dumped nar of {path} is bigger than the "
+                    "store says")
+
+class NarPrefetcher:
+    # exports nars ahead of when they're needed using several store connections
+    # so the store isn't idle while the previous nar is being compressed. nars
+    # must be consumed in the order given. at most buffer_size bytes of nars are
+    # held in memory; nars bigger than that are streamed from the given store
+    # once they come up. with direct, the extra connections are replaced by
+    # threads dumping nars with a DirectNarSource.
+
+    def __init__(self, store, path_infos, store_root="", jobs=2,
+            buffer_size=268435456, direct=False):
+        self._store = store
+        self._store_root = store_root
+        self._direct = direct
+        self._path_infos = list(path_infos)
+        self._jobs = jobs
+        self._buffer_size = buffer_size
+
+        self._cond = threading.Condition()
+        self._next_dispatch = 0
+        self._next_consume = 0
+        self._buffered = 0
+        self._results = {}
+        self._error = None
+        self._stopping = False
+        self._threads = []
+
+    def __enter__(self):
+        for _ in range(self._jobs):
+            thread = threading.Thread(target=self._worker, daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        with self._cond:
+            self._stopping = True
+            self._cond.notify_all()
+
+        for thread in self._threads:
+            thread.join()
+
+    def _next_job(self):
+        # get the next nar to export. they are handed out in order so the nar
+        # the consumer is waiting on always fits in the buffer eventually.
+        with self._cond:
+            while True:
+                if self._stopping or \
+                        self._next_dispatch == len(self._path_infos):
+                    return None, None
+
+                idx = self._next_dispatch
+                path_info = self._path_infos[idx]
+                if path_info.nar_size > self._buffer_size:
+                    # too big to buffer, the consumer will stream it itself
+                    self._next_dispatch += 1
+                    self._results[idx] = None
+                    self._cond.notify_all()
+                elif self._buffered + path_info.nar_size <= self._buffer_size:
+                    self._next_dispatch += 1
+                    self._buffered += path_info.nar_size
+                    return idx, path_info
+                else:
+                    self._cond.wait()
+
+    def _worker(self):
+        if self._direct:
+            source = DirectNarSource(self._store_root)
+        else:
+            source = LocalStore(self._store_root)
+
+        try:
+            with source as store:
+                while True:
+                    idx, path_info = self._next_job()
+                    if idx is None:
+                        break
+
+                    nar = []
+                    with stats.phase("export", bytes_out=path_info.nar_size,
+                            path=path_info.path):
+                        store.source_nar_into(path_info.path,
+                            path_info.nar_size,
+                            lambda fp: nar.append(fp.read(path_info.nar_size)))
+
+                    with self._cond:
+                        self._results[idx] = nar[0]
+                        self._cond.notify_all()
+        except BaseException as e:
+            with self._cond:
+                if self._error is None:
+                    self._error = e
+                self._cond.notify_all()
+
+    def source_nar_into(self, path, size, nar_sink_fn):
+        # same as StoreCommunicator.source_nar_into but must be called for each
+        # path in order
+
+        if self._jobs == 0: # nobody is prefetching
+            return self._store.source_nar_into(path, size, nar_sink_fn)
+
+        with self._cond:
+            idx = self._next_consume
+            if idx >= len(self._path_infos) or \
+                    self._path_infos[idx].path != path:
+                raise RuntimeError(f"nar for {path} requested out of order")
+
+            with stats.span("wait for export", path=path):
+                while idx not in self._results:
+                    if self._error is not None:
+                        raise RuntimeError("failed to export nar") \
+                            from self._error
+                    self._cond.wait()
+
+            nar = self._results.pop(idx)
+            self._next_consume += 1
+
+        if nar is None:
+            return self._store.source_nar_into(path, size, nar_sink_fn)
+
+        try:
+            nar_sink_fn(io.BytesIO(nar))
+        finally:
+            with self._cond:
+                self._buffered -= size
+                self._cond.notify_all()
+
+class NarSinkPool:
+    # writes nars into the store using several store connections at once so the
+    # store's hashing and unpacking of independent paths can happen in
+    # parallel. each nar is held in memory until every path it references that
+    # was given earlier is in the store, so nars must be given in topological
+    # order. at most buffer_size bytes of nars are held in memory; nars bigger
+    # than that are written by the given store once everything before them is.
+
+    def __init__(self, store, store_root="", jobs=2, buffer_size=268435456):
+        self._store = store
+        self._store_root = store_root
+        self._jobs = jobs
+        self._buffer_size = buffer_size
+
+        self._cond = threading.Condition()
+        self._jobs_waiting = [] # (path_info, nar, paths it waits on)
+        self._in_flight = set() # paths given to us but not yet in the store
+        self._buffered = 0
+        self._error = None
+        self._stopping = False
+        self._threads = []
+
+    def __enter__(self):
+        for _ in range(self._jobs):
+            thread = threading.Thread(target=self._worker, daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        with self._cond:
+            if exc_type is None:
+                # let the workers finish everything first
+                while len(self._in_flight) > 0 and self._error is None:
+                    self._cond.wait()
+            self._stopping = True
+            self._cond.notify_all()
+
+        for thread in self._threads:
+            thread.join()
+
+        if exc_type is None:
+            self._check_error()
+
+    def _check_error(self):
+        # must be called with the lock held or after the workers are done
+        if self._error is not None:
+            raise RuntimeError("failed to import nar") from self._error
+
+    def _next_job(self):
+        with self._cond:
+            while True:
+                if self._stopping or self._error is not None:
+                    return None
+
+                for idx, job in enumerate(self._jobs_waiting):
+                    if len(job[2] & self._in_flight) == 0:
+                        return self._jobs_waiting.pop(idx)
+
+                self._cond.wait()
+
+    def _worker(self):
+        try:
+            with LocalStore(self._store_root) as store:
+                while True:
+                    job = self._next_job()
+                    if job is None:
+                        break
+                    path_info, nar, _ = job
+
+                    if not self._ingest(store, path_info, io.BytesIO(nar)):
+                        raise RuntimeError(
+                            f"store rejected {path_info.path}")
+
+                    with self._cond:
+                        self._in_flight.remove(path_info.path)
+                        self._buffered -= path_info.nar_size
+                        self._cond.notify_all()
+        except BaseException as e:
+            with self._cond:
+                if self._error is None:
+                    self._error = e
+                self._cond.notify_all()
+
+    def _ingest(self, store, path_info, fp):
+        # includes time waiting for the nar to come out of fp
+        with stats.phase("ingest", bytes_in=path_info.nar_size,
+                path=path_info.path):
+            return store.sink_nar_from(path_info, fp)
+
+    def _sink_nar_directly(self, path_info, fp):
+        if not self._ingest(self._store, path_info, fp):
+            # fail the same way as if a worker had written it
+            with self._cond:
+                if self._error is None:
+                    self._error = RuntimeError(
+                        f"store rejected {path_info.path}")
+                self._cond.notify_all()
+                self._check_error()
+        return True
+
+    def sink_nar_from(self, path_info, fp):
+        # same as StoreCommunicator.sink_nar_from, but the nar might not be in
+        # the store until the pool is exited, and a nar the store rejects
+        # raises instead of returning False
+
+        if self._jobs == 0: # nobody to give it to
+            return self._sink_nar_directly(path_info, fp)
+
+        with self._cond:
+            self._check_error()
+            waits_on = (set(path_info.references) & self._in_flight) - \
+                {path_info.path}
+
+            with stats.span("wait for ingest", path=path_info.path):
+                if path_info.nar_size > self._buffer_size:
+                    # too big to hold, write it ourselves once its
+                    # references are in the store
+                    while len(waits_on & self._in_flight) > 0:
+                        self._cond.wait()
+                        self._check_error()
+                else:
+                    while self._buffered + path_info.nar_size > \
+                            self._buffer_size:
+                        self._cond.wait()
+                        self._check_error()
+                    self._buffered += path_info.nar_size
+
+        if path_info.nar_size > self._buffer_size:
+            return self._sink_nar_directly(path_info, fp)
+
+        try:
+            nar = fp.read(path_info.nar_size)
+        except BaseException:
+            with self._cond:
+                self._buffered -= path_info.nar_size
+            raise
+
+        with self._cond:
+            self._in_flight.add(path_info.path)
+            self._jobs_waiting.append((path_info, nar, waits_on))
+            self._cond.notify_all()
+
+        return True
+
+class NarTee:
+    # writes each nar into whichever of several sinks need it while reading it
+    # only once. each sink has its own thread which is fed chunks of the nar
+    # through a small queue, so the sinks all work at the same time and the
+    # slowest one sets the pace. each sink gets its nars in the order given.
+
+    def __init__(self, sinks, chunk_size=1048576, queue_chunks=16):
+        self._sinks = list(sinks)
+        self._chunk_size = chunk_size
+        self._queue_chunks = queue_chunks
+
+        self._jobs = [queue.Queue() for _ in self._sinks]
+        self._error = None
+        self._threads = []
+
+    def __enter__(self):
+        for sink, jobs in zip(self._sinks, self._jobs):
+            thread = threading.Thread(target=self._worker, args=(sink, jobs),
+                daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        for jobs in self._jobs:
+            jobs.put(None)
+        for thread in self._threads:
+            thread.join()
+
+        if exc_type is None:
+            self._check_error()
+
+    def _check_error(self):
+        if self._error is not None:
+            raise RuntimeError("failed to import nar") from self._error
+
+    def _worker(self, sink, jobs):
+        while True:
+            job = jobs.get()
+            if job is None:
+                break
+            path_info, reader = job
+
+            try:
+                if self._error is None and \
+                        not sink.sink_nar_from(path_info, reader):
+                    raise RuntimeError(f"store rejected {path_info.path}")
+            except BaseException as e:
+                if self._error is None:
+                    self._error = e
+            # keep taking chunks so the tee doesn't get stuck on us
+            try:
+                reader.drain()
+            except BaseException:
+                pass
+
+    def sink_nar_from(self, path_info, fp, sinks):
+        # write the nar into the given sinks, which must be some of the ones
+        # the tee was created with
+        self._check_error()
+
+        readers = []
+        for sink in sinks:
+            reader = _ChunkReader(self._queue_chunks)
+            self._jobs[self._sinks.index(sink)].put((path_info, reader))
+            readers.append(reader)
+
+        try:
+            remaining = path_info.nar_size
+            while remaining > 0:
+                data = fp.read(min(remaining, self._chunk_size))
+                if len(data) == 0:
+                    break
+                for reader in readers:
+                    reader.put(data)
+                remaining -= len(data)
+        except BaseException as e:
+            for reader in readers:
+                reader.put(e)
+            raise
+
+        for reader in readers:
+            reader.put(b"") # end of the nar
+
+class _ChunkReader:
+    # file-like reader of chunks put into it by another thread. an empty chunk
+    # is the end, and an exception is raised by the reader.
+
+    def __init__(self, max_chunks):
+        self._queue = queue.Queue(max_chunks)
+        self._chunk = memoryview(b"")
+        self._eof = False
+
+    def put(self, data):
+        self._queue.put(data)
+
+    def _fill(self):
+        if len(self._chunk) == 0 and not self._eof:
+            data = self._queue.get()
+            if isinstance(data, BaseException):
+                self._eof = True
+                raise RuntimeError("failed to read nar") from data
+            if len(data) == 0:
+                self._eof = True
+            self._chunk = memoryview(data)
+
+    def readinto(self, b):
+        self._fill()
+        num_read = min(len(b), len(self._chunk))
+        b[:num_read] = self._chunk[:num_read]
+        self._chunk = self._chunk[num_read:]
+        return num_read
+
+    def read(self, size=-1):
+        chunks = []
+        while size != 0:
+            self._fill()
+            if len(self._chunk) == 0:
+                break
+            num_read = len(self._chunk) if size < 0 else \
+                min(size, len(self._chunk))
+            chunks.append(self._chunk[:num_read])
+            self._chunk = self._chunk[num_read:]
+            if size > 0:
+                size -= num_read
+        return b"".join(chunks)
+
+    def drain(self):
+        while not self._eof:
+            self._chunk = memoryview(b"")
+            self._fill()
+
 class StoreCommunicator:
     def __init__(self, fin, fout):
         self._fin = fin
@@ -113,7 +650,7 @@ class StoreCommunicator:
         return struct.unpack("<Q", self._fin.read(8))[0]
 
     def _write_num(self, num):
-        self._fout.write(struct.pack("<Q", num))
+        self._fout.write(_pack_num(num))
 
     def _read_string(self):
         blob_len = self._read_num()
@@ -124,10 +661,8 @@ class StoreCommunicator:
 
     def _write_string(self, string):
         blob = string.encode("utf8")
-        self._write_num(len(blob))
-        self._fout.write(blob)
-        if len(blob) % 8 > 0:
-            self._fout.write(b"\x00"*(8-(len(blob)%8)))
+        self._fout.write(b"".join(
+            (_pack_num(len(blob)), blob, _PADDING[len(blob)%8])))
 
     def _read_strings(self):
         num_strings = self._read_num()
@@ -137,32 +672,82 @@ class StoreCommunicator:
         return strings
 
     def _write_strings(self, strings):
-        self._write_num(len(strings))
+        # build the whole list up and write it at once
+        parts = [_pack_num(len(strings))]
         for string in strings:
-            self._write_string(string)
-
-    def query_valid_paths(self, paths, lock=True, substitute=False):
+            blob = string.encode("utf8")
+            parts.append(_pack_num(len(blob)))
+            parts.append(blob)
+            parts.append(_PADDING[len(blob)%8])
+        self._fout.write(b"".join(parts))
+
+    def _pipeline(self, command, send_fns, receive_fn):
+        # send several requests before reading any of their replies, so the
+        # store doesn't sit idle waiting on a round trip for each. the
+        # requests are written on another thread so that a big reply filling
+        # up the pipe can't stop the store reading while we're still writing.
+        with stats.span(command.name.lower(), requests=len(send_fns)):
+            if len(send_fns) == 1:
+                send_fns[0]()
+                self._fout.flush()
+                return [receive_fn()]
+
+            error = []
+            def send():
+                try:
+                    for send_fn in send_fns:
+                        send_fn()
+                    self._fout.flush()
+                except BaseException as e:
+                    error.append(e)
+
+            thread = threading.Thread(target=send, daemon=True)
+            thread.start()
+            try:
+                replies = [receive_fn() for _ in send_fns]
+            finally:
+                thread.join()
+
+            if len(error) > 0:
+                raise error[0]
+            return replies
+
+    def _send_query_valid_paths(self, paths, lock, substitute):
         self._write_num(ServeCommand.QUERY_VALID_PATHS)
         self._write_num(int(bool(lock)))
         self._write_num(int(bool(substitute)))
         self._write_strings(paths)
-        self._fout.flush()
 
-        return self._read_strings()
+    def query_valid_paths(self, paths, lock=True, substitute=False):
+        return self._pipeline(ServeCommand.QUERY_VALID_PATHS,
+            [lambda: self._send_query_valid_paths(paths, lock, substitute)],
+            self._read_strings)[0]
 
-    def query_closure(self, paths, include_outputs=False):
+    def _send_query_closure(self, paths, include_outputs):
         self._write_num(ServeCommand.QUERY_CLOSURE)
         self._write_num(int(bool(include_outputs)))
         self._write_strings(paths)
-        self._fout.flush()
 
-        return self._read_strings()
+    def query_closure(self, paths, include_outputs=False):
+        return self.query_closures([paths], include_outputs)[0]
 
-    def query_path_infos(self, paths):
+    def query_closures(self, path_lists, include_outputs=False):
+        # query the closure of each list of paths, all in one go
+        return self._pipeline(ServeCommand.QUERY_CLOSURE,
+            [lambda paths=paths: self._send_query_closure(paths,
+                include_outputs) for paths in path_lists],
+            self._read_strings)
+
+    def _send_query_path_infos(self, paths):
         self._write_num(ServeCommand.QUERY_PATH_INFOS)
         self._write_strings(paths)
-        self._fout.flush()
 
+    def query_path_infos(self, paths):
+        return self._pipeline(ServeCommand.QUERY_PATH_INFOS,
+            [lambda: self._send_query_path_infos(paths)],
+            self._read_path_infos)[0]
+
+    def _read_path_infos(self):
         path_infos = []
         while True:
             path = self._read_string()
@@ -195,35 +780,37 @@ class StoreCommunicator:
         # read a nar from the store and take a function which is provided the
         # fp and that reads the nar data out of it
 
-        self._write_num(ServeCommand.DUMP_STORE_PATH)
-        self._write_string(path)
-        self._fout.flush()
+        with stats.span("dump_store_path", path=path):
+            self._write_num(ServeCommand.DUMP_STORE_PATH)
+            self._write_string(path)
+            self._fout.flush()
 
-        nar_sink_fn(self._fin)
+            nar_sink_fn(self._fin)
 
     def sink_nar_from(self, path_info, fp):
         # write a nar into the store, taking an fp which the nar data is read
         # out of
-        self._write_num(ServeCommand.ADD_TO_STORE_NAR)
-        self._write_string(path_info.path)
-        self._write_string(path_info.deriver)
-        self._write_string(path_info.nar_hash)
-        self._write_strings(path_info.references)
-        self._write_num(0) # registrationTime
-        self._write_num(path_info.nar_size)
-        self._write_num(0) # ultimate: did we actually build this nar?
-        self._write_strings(path_info.sigs)
-        self._write_string(path_info.ca_info)
-
-        size = path_info.nar_size
-        while size > 0:
-            num_read = fp.readinto(self._buf[:min(size, len(self._buf))])
-            if num_read == 0:
-                break
-
-            self._fout.write(self._buf[:num_read])
-            size -= num_read
-
-        self._fout.flush()
-
-        return bool(self._read_num()) # success?
+        with stats.span("add_to_store_nar", path=path_info.path):
+            self._write_num(ServeCommand.ADD_TO_STORE_NAR)
+            self._write_string(path_info.path)
+            self._write_string(path_info.deriver)
+            self._write_string(path_info.nar_hash)
+            self._write_strings(path_info.references)
+            self._write_num(0) # registrationTime
+            self._write_num(path_info.nar_size)
+            self._write_num(0) # ultimate: did we actually build this nar?
+            self._write_strings(path_info.sigs)
+            self._write_string(path_info.ca_info)
+
+            size = path_info.nar_size
+            while size > 0:
+                num_read = fp.readinto(self._buf[:min(size, len(self._buf))])
+                if num_read == 0:
+                    break
+
+                self._fout.write(self._buf[:num_read])
+                size -= num_read
+
+            self._fout.flush()
+
+            return bool(self._read_num()) # success?
@@ -0,0 +1,70 @@
+# a cache of store path infos which persists between shipfile creations.
+#
+# the contents of a store path never change once it is valid, so its path info
+# can be remembered instead of asking the store for it again. the exception is
+# if a path is deleted and then built again non-reproducibly, which gives it a
+# different nar, so the cache is only used when asked for. signatures added to
+# a path after it was cached won't be seen either.
+#
+# the cache is an SQLite database with one table mapping each store path to its
+# path info as JSON.
+
+import json
+import pathlib
+import sqlite3
+
+from .nix_store import PathInfo
+
+# how many paths to look up in one query, to stay under SQLite's limit on
+# the number of parameters
+LOOKUP_BATCH_SIZE = 500
+
+class PathInfoCache:
+    def __init__(self, path):
+        path = pathlib.Path(path)
+        path.parent.mkdir(parents=True, exist_ok=True)
+
+        self._db = sqlite3.connect(path)
+        with self._db:
+            self._db.execute("CREATE TABLE IF NOT EXISTS path_infos "
+                "(path TEXT PRIMARY KEY, info TEXT NOT NULL)")
+
+    def close(self):
+        self._db.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def lookup(self, paths):
+        # return a dict of path -> path info for the given paths in the cache
+        paths = list(paths)
+        found = {}
+        for start in range(0, len(paths), LOOKUP_BATCH_SIZE):
+            batch = paths[start:start+LOOKUP_BATCH_SIZE]
+            rows = self._db.execute("SELECT path, info FROM path_infos "
+                f"WHERE path IN ({','.join('?'*len(batch))})", batch)
+            for path, info in rows:
+                found[path] = PathInfo(**json.loads(info))
+
+        return found
+
+    def add(self, path_infos):
+        with self._db:
+            self._db.executemany("INSERT OR REPLACE INTO path_infos "
+                "(path, info) VALUES (?, ?)",
+                ((p.path, json.dumps(p._asdict())) for p in path_infos))
+
+    def query_path_infos(self, store, paths):
+        # same as StoreCommunicator.query_path_infos, but only asking the store
+        # about paths which aren't in the cache
+        found = self.lookup(paths)
+        missing = [p for p in paths if p not in found]
+        if len(missing) > 0:
+            queried = store.query_path_infos(missing)
+            self.add(queried)
+            found.update((p.path, p) for p in queried)
+
+        return [found[p] for p in paths if p in found]
@@ -1,11 +1,23 @@
+import hashlib
 import io
+import os
+import shutil
 import tarfile
 import json
+import mmap
+import queue
+import struct
 import sys
+import threading
+import contextlib
 
 import zstandard
 
-from .nix_store import PathInfo
+from .nix_store import PathInfo, StoreGraph, sort_path_infos
+from .nar import NarParser, read_exact
+from . import stats
+from .narinfo_index import NarinfoIndexError, dump_narinfo_index, \
+    load_narinfo_index
 
 def get_compressor(compression):
     if compression == "ultra":
@@ -20,6 +32,44 @@ def get_compressor(compression):
 
     return zstandard.ZstdCompressor(compression_params=params)
 
+def get_patch_compressor(compression, base_nar, nar_size):
+    # compress using the base nar as a raw content dictionary, like zstd's
+    # --patch-from. the window has to cover both nars to find matches in the
+    # base from anywhere in the new nar.
+    level = {"ultra": 22, "normal": 9, "fast": 3}[compression]
+    window_log = min(31, max(10, (len(base_nar)+nar_size).bit_length()))
+    params = zstandard.ZstdCompressionParameters.from_level(level,
+        source_size=nar_size, dict_size=len(base_nar), window_log=window_log)
+    # long distance matching doesn't look in dictionaries, and zstd only
+    # indexes as much of one as its tables cover, so make them cover the base
+    # like --patch-from does (up to a point, as they take 8 bytes per entry).
+    # the fast strategies find next to nothing in a big dictionary however
+    # big their tables are, so search at least greedily.
+    table_log = min(window_log, PATCH_MAX_TABLE_LOG)
+    params = zstandard.ZstdCompressionParameters.from_level(level,
+        source_size=nar_size, dict_size=len(base_nar), window_log=window_log,
+        hash_log=max(params.hash_log, table_log),
+        chain_log=max(params.chain_log, table_log),
+        strategy=max(params.strategy, zstandard.STRATEGY_GREEDY),
+        threads=-1)
+
+    return zstandard.ZstdCompressor(compression_params=params,
+        dict_data=get_patch_dict(base_nar))
+
+def get_patch_dict(base_nar):
+    return zstandard.ZstdCompressionDict(base_nar,
+        dict_type=zstandard.DICT_TYPE_RAWCONTENT)
+
+def nar_member_name(nar_hash, ext="nar"):
+    return f"nar/{nar_hash.split(':')[1]}.{ext}"
+
+def copy_exact(fp, size, data_fn, chunk_size=1048576):
+    # read exactly size bytes out of fp and give them to data_fn in chunks
+    while size > 0:
+        data = read_exact(fp, min(size, chunk_size))
+        data_fn(data)
+        size -= len(data)
+
 def dump_json(obj):
     # dump an object as json with reproducible settings
     dumped = json.dumps(obj,indent=2, sort_keys=True, ensure_ascii=False)
@@ -56,6 +106,83 @@ class ShipfileError(RuntimeError):
 
 # maximum expected size of anything which is not a .nar file
 MAX_METADATA_SIZE = 1048576
+# indices describe every path, so are allowed to be a lot bigger
+MAX_INDEX_SIZE = MAX_METADATA_SIZE*64
+
+# files smaller than this aren't worth deduplicating, the compression will
+# probably notice them anyway
+DEDUP_MIN_FILE_SIZE = 4096
+
+# the seekable index footer is a zstd skippable frame at the very end of the
+# file which points to the frame containing the index member
+SEEKABLE_FOOTER_MAGIC = 0x184D2A53 # skippable frame magic for the footer
+SEEKABLE_FOOTER_TAG = b"shfindex"
+SEEKABLE_FOOTER_FORMAT = "<IIQQ8s"
+SEEKABLE_FOOTER_SIZE = struct.calcsize(SEEKABLE_FOOTER_FORMAT)
+
+# size of the reused buffer member data is read into on its way to the
+# compressor, and of the chunks the compressor writes out
+WRITE_BUFFER_SIZE = 4*1048576
+
+# how much of the next part of a split shipfile to ask the kernel to read ahead
+SPLIT_PREFETCH_SIZE = 64*1048576
+# biggest hash and chain tables to use for finding matches in patch bases;
+# bases bigger than this are only partly searched
+PATCH_MAX_TABLE_LOG = 27
+# biggest part of a split shipfile to memory map instead of reading
+MAX_MAP_SIZE = 1024*1048576
+
+_stdout_file = None
+
+def claim_stdout():
+    # take over stdout for shipfile data and point anything else that would be
+    # printed there, including by subprocesses, at stderr instead
+    global _stdout_file
+    if _stdout_file is None:
+        sys.stdout.flush()
+        data_fd = os.dup(1)
+        os.dup2(2, 1)
+        _stdout_file = os.fdopen(data_fd, "wb")
+
+    return _stdout_file
+
+class StreamWriter:
+    # writes to a stream which can't tell us where it is, e.g. a pipe
+
+    def __init__(self, file):
+        self._file = file
+        self._pos = 0
+
+    def write(self, data):
+        self._file.write(data)
+        self._pos += len(data)
+        return len(data)
+
+    def tell(self):
+        return self._pos
+
+    def close(self):
+        return self._file.close()
+
+class CaptureWriter:
+    # passes writes through to a file, copying them somewhere else as well
+    # while capturing
+
+    def __init__(self, file):
+        self._file = file
+        self.capture = None
+
+    def write(self, data):
+        if self.capture is not None:
+            self.capture.write(data)
+        return self._file.write(data)
+
+    def flush(self):
+        if hasattr(self._file, "flush"):
+            self._file.flush()
+
+    def close(self):
+        return self._file.close()
 
 class SplitWriter:
     def __init__(self, path, split_size):
@@ -68,6 +195,8 @@ class SplitWriter:
         self._curr_size = 0
 
     def write(self, data):
+        # slicing a view of the data doesn't copy it
+        data = memoryview(data)
         total_len = len(data)
         while len(data) > 0:
             data_len = len(data)
@@ -87,11 +216,16 @@ class SplitWriter:
 
         return total_len
 
+    def tell(self):
+        return self._file_number*self._split_size + self._curr_size
+
     def close(self):
         return self._file.close()
 
 class ShipfileWriter:
-    def __init__(self, workdir, path, compression="normal", split_size=None):
+    def __init__(self, workdir, path, compression="normal", split_size=None,
+            seekable=False, file_dedup=False, nar_cache=None,
+            narinfo_index=True):
         if split_size is not None and split_size < 1048576:
             raise ValueError("split_size must be at least 1M")
             # if not then the marker to open in split mode might not be in the
@@ -101,34 +235,143 @@ class ShipfileWriter:
         self.workdir = workdir
         self.workdir.mkdir(parents=True)
 
+        self._compression = compression
         compressor = get_compressor(compression)
         self._is_split = split_size is not None
-        if self._is_split:
+        if str(path) == "-":
+            if self._is_split:
+                raise ValueError("can't split a shipfile written to stdout")
+            self._file = StreamWriter(claim_stdout())
+        elif self._is_split:
             self._file = SplitWriter(path, split_size)
         else:
             self._file = open(path, "wb")
-        self._writer = compressor.stream_writer(self._file)
+        # the compressed data for a nar can be captured to put in the cache
+        self._capture = CaptureWriter(self._file)
+        self._writer = compressor.stream_writer(self._capture,
+            write_size=WRITE_BUFFER_SIZE)
+        self._write_buf = memoryview(bytearray(WRITE_BUFFER_SIZE))
         self._tar = tarfile.open(fileobj=self._writer, mode="w:",
             format=tarfile.PAX_FORMAT)
 
+        # in seekable mode, each nar is put in its own zstd frame and we
+        # remember where each frame is so we can write an index at the end
+        self._is_seekable = seekable
+        self._nar_index = {}
+        self._file_index = {} # same, for deduplicated files by hash
+        self._frame_dirty = False
+
+        # with file deduplication, we remember the hashes of the big files in
+        # each nar so the duplicated ones can be written only once
+        self._is_file_dedup = file_dedup
+        self._dedup_counts = {} # file hash -> number of times seen
+        self._dedup_nar_files = {} # nar hash -> hashes of its big files
+        self._dedup_files = set() # file hashes seen more than once
+        self._dedup_nars = set() # nar hashes containing any of those
+        self._dedup_written = set() # file hashes written into the shipfile
+
+        # the nar cache holds the frames of previously compressed nars, which
+        # can only be reused if each nar is in its own frame
+        if nar_cache is not None and not seekable:
+            raise ValueError("a nar cache requires a seekable shipfile")
+        self._nar_cache = nar_cache
+
+        # with the narinfo index, the narinfos are held back until they are
+        # all known so the index describing them can be written first
+        self._is_narinfo_index = narinfo_index
+        self._pending_narinfos = [] # (name, contents, index entry)
+
     def close(self):
-        self._tar.close()
-        self._writer.close()
+        self._finish_narinfos()
+        if not self._is_seekable:
+            self._tar.close()
+            self._writer.close()
+            self._file.close()
+            return
+
+        index_offset = self._end_frame()
+        index = {"nars": {nar_hash: {"offset": o, "length": l}
+            for nar_hash, (o, l) in self._nar_index.items()}}
+        if len(self._file_index) > 0:
+            index["files"] = {file_hash: {"offset": o, "length": l}
+                for file_hash, (o, l) in self._file_index.items()}
+        self._write_contents("shipfile/index/nar_index.json",
+            dump_json(index))
+        self._tar.close() # end of archive goes in the index frame too
+        index_length = self._end_frame() - index_offset
+
+        # the footer goes after all the frames. we don't close the writer
+        # because that would write an empty frame after the footer.
+        self._file.write(struct.pack(SEEKABLE_FOOTER_FORMAT,
+            SEEKABLE_FOOTER_MAGIC, SEEKABLE_FOOTER_SIZE-8,
+            index_offset, index_length, SEEKABLE_FOOTER_TAG))
         self._file.close()
 
-    def _write_fp(self, path, size, fp):
+    def _end_frame(self):
+        # finish the current zstd frame (if anything is in it) and return the
+        # offset in the file where the next one starts
+        if self._frame_dirty:
+            self._writer.flush(zstandard.FLUSH_FRAME)
+            self._frame_dirty = False
+
+        return self._file.tell()
+
+    def _member_header(self, path, size):
         info = tarfile.TarInfo(path)
         info.type = tarfile.REGTYPE # regular file
         info.size = size
 
-        self._tar.addfile(info, fp)
+        return info.tobuf(self._tar.format, self._tar.encoding,
+            self._tar.errors)
+
+    def _member_size(self, path, size):
+        # bytes a member takes up in the archive, including its header
+        blocks = (size+tarfile.BLOCKSIZE-1)//tarfile.BLOCKSIZE
+        return len(self._member_header(path, size)) + blocks*tarfile.BLOCKSIZE
+
+    def _write_fp(self, path, size, fp):
+        # write a member the same as tarfile.addfile, except the data is read
+        # into one reused buffer and views of it are given to the compressor,
+        # so nothing is copied or allocated for each chunk. the member isn't
+        # remembered by the tarfile either, which would just waste memory.
+        header = self._member_header(path, size)
+        self._writer.write(header)
+
+        remaining = size
+        while remaining > 0:
+            buf = self._write_buf[:min(remaining, len(self._write_buf))]
+            # includes waiting on whatever is producing the data
+            with stats.span("read"):
+                num_read = fp.readinto(buf)
+            if num_read == 0:
+                raise OSError("unexpected end of data")
+            with stats.span("compress chunk", size=num_read):
+                self._writer.write(buf[:num_read])
+            remaining -= num_read
+
+        # pad out to a whole tar block
+        blocks, remainder = divmod(size, tarfile.BLOCKSIZE)
+        if remainder > 0:
+            self._writer.write(tarfile.NUL*(tarfile.BLOCKSIZE-remainder))
+            blocks += 1
+
+        self._tar.offset += len(header) + blocks*tarfile.BLOCKSIZE
+        self._frame_dirty = True
 
     def _write_contents(self, path, contents):
         self._write_fp(path, len(contents), io.BytesIO(contents))
 
     def write_version_info(self, mandatory_features=[], optional_features=[]):
+        mandatory_features = list(mandatory_features)
+        optional_features = list(optional_features)
         if self._is_split:
             mandatory_features.append("simple_split")
+        if self._is_seekable:
+            mandatory_features.append("seekable_index")
+        if self._is_file_dedup:
+            mandatory_features.append("file_dedup")
+        if self._is_narinfo_index:
+            optional_features.append("narinfo_index")
 
         contents = dump_json({
             "mandatory_features": sorted(mandatory_features),
@@ -149,10 +392,20 @@ class ShipfileWriter:
 
         self._write_contents("shipfile/store/nix-cache-info", contents)
 
-    def write_narinfo(self, path_info, in_file):
+    def write_narinfo(self, path_info, in_file, patch_base=None):
         url = ""
+        dedup_files = []
         if in_file:
-            url = f"nar/{path_info.nar_hash.split(':')[1]}.nar"
+            if patch_base is not None:
+                url = nar_member_name(path_info.nar_hash, "patch")
+            elif path_info.nar_hash in self._dedup_nars:
+                url = nar_member_name(path_info.nar_hash, "dedup")
+                # so the receiver knows which files it needs to keep
+                dedup_files = sorted(file_hash.hex() for file_hash in
+                    set(self._dedup_nar_files[path_info.nar_hash])
+                        & self._dedup_files)
+            else:
+                url = nar_member_name(path_info.nar_hash)
 
         refs = " ".join(r.replace("/nix/store/", "")
             for r in path_info.references)
@@ -171,45 +424,535 @@ class ShipfileWriter:
             +(f"Deriver: {deriver}\n" if deriver != "" else "")
             +("".join(f"Sig: {s}\n" for s in path_info.sigs))
             +(f"CA: {path_info.ca_info}\n" if path_info.ca_info != "" else "")
-        ).encode("ascii")
+        )
+        if patch_base is not None:
+            contents += (
+                "PatchBase: "+patch_base.path.replace("/nix/store/", "")+"\n"
+                +f"PatchBaseHash: {patch_base.nar_hash}\n"
+            )
+        if len(dedup_files) > 0:
+            contents += "DedupFiles: "+" ".join(dedup_files)+"\n"
+        contents = contents.encode("ascii")
 
         p = path_info.path.replace("/nix/store/", "").split("-")[0]
-        self._write_contents(f"shipfile/store/{p}.narinfo", contents)
+        name = f"shipfile/store/{p}.narinfo"
+        if self._pending_narinfos is None or not self._is_narinfo_index:
+            self._write_contents(name, contents)
+        else:
+            self._pending_narinfos.append((name, contents, (path_info, url,
+                None if patch_base is None else
+                    (patch_base.path, patch_base.nar_hash), dedup_files)))
+
+    def _finish_narinfos(self):
+        # write out the narinfo index and the narinfos it describes, once all
+        # the narinfos have been given to us
+
+        pending = self._pending_narinfos
+        self._pending_narinfos = None
+        if not pending:
+            return
+
+        narinfo_size = sum(self._member_size(name, len(contents))
+            for name, contents, _ in pending)
+        try:
+            index = dump_narinfo_index([e for _, _, e in pending],
+                narinfo_size)
+        except NarinfoIndexError:
+            # the reader will have to make do with the narinfos themselves
+            index = None
+        if index is not None and len(index) <= MAX_INDEX_SIZE:
+            self._write_contents("shipfile/store/narinfo.index", index)
+
+        for name, contents, _ in pending:
+            self._write_contents(name, contents)
+
+    def _write_nar_member(self, nar_hash, name, size, fp):
+        with stats.span("tar write", member=name):
+            if not self._is_seekable:
+                self._write_fp(f"shipfile/store/{name}", size, fp)
+                return
+
+            offset = self._end_frame()
+            self._write_fp(f"shipfile/store/{name}", size, fp)
+            length = self._end_frame() - offset
+        # identical nars have identical contents so we only need the first
+        self._nar_index.setdefault(nar_hash, (offset, length))
+
+    @contextlib.contextmanager
+    def _nar_phase(self, name, nar_hash, nar_size):
+        # record how long writing a nar took and what it compressed to. if the
+        # shipfile isn't seekable, the compressor holds on to data between
+        # nars, so the compressed size of each one isn't known
+        if self._is_seekable:
+            # so whatever came before the nar isn't counted as part of it
+            self._end_frame()
+        start = self._file.tell()
+        with stats.phase(name, bytes_in=nar_size, nar=nar_hash) as record:
+            yield
+            record.bytes_out = self._file.tell() - start
+        stats.add_nar(nar_hash, nar_size, record.bytes_out,
+            exact=self._is_seekable)
 
     def sink_nar_into(self, nar_hash, nar_size, fp):
         # write a nar into the shipfile, taking an fp to get the nar data from
+        self._finish_narinfos()
+
+        with self._nar_phase("compress", nar_hash, nar_size):
+            self._sink_nar_into(nar_hash, nar_size, fp)
+
+    def _sink_nar_into(self, nar_hash, nar_size, fp):
+        if nar_hash in self._dedup_nars:
+            return self._sink_nar_dedup_into(nar_hash, nar_size, fp)
 
-        self._write_fp(f"shipfile/store/nar/{nar_hash.split(':')[1]}.nar",
-            nar_size, fp)
+        if self._nar_cache is None:
+            self._write_nar_member(nar_hash, nar_member_name(nar_hash),
+                nar_size, fp)
+            return
+
+        # remember the frame we write so next time we can just copy it
+        self._end_frame()
+        member_start = self._tar.offset
+        cache_entry = self._nar_cache.add(self._compression, nar_hash)
+        self._capture.capture = cache_entry
+        try:
+            self._write_nar_member(nar_hash, nar_member_name(nar_hash),
+                nar_size, fp)
+        except BaseException:
+            cache_entry.abort()
+            raise
+        finally:
+            self._capture.capture = None
+        cache_entry.commit(self._tar.offset - member_start)
+
+    def has_cached_nar(self, nar_hash):
+        # true if splice_cached_nar will probably be able to write the nar
+        return self._nar_cache is not None and \
+            nar_hash not in self._dedup_nars and \
+            self._nar_cache.contains(self._compression, nar_hash)
+
+    def splice_cached_nar(self, nar_hash, nar_size):
+        # copy a previously compressed nar out of the cache into the shipfile,
+        # returning False if it is not available
+
+        if not self.has_cached_nar(nar_hash):
+            return False
+        self._finish_narinfos()
+        entry = self._nar_cache.open(self._compression, nar_hash)
+        if entry is None: # evicted just now
+            return False
+        member_size, fp = entry
+
+        with fp, stats.phase("splice cached", bytes_in=nar_size,
+                nar=nar_hash) as record:
+            offset = self._end_frame()
+            shutil.copyfileobj(fp, self._file, 1048576)
+            length = self._end_frame() - offset
+            record.bytes_out = length
+        # the frame is the nar's alone, so its size is exact
+        stats.add_nar(nar_hash, nar_size, length)
+        # keep the tarfile's idea of where it is in the archive correct
+        self._tar.offset += member_size
+        self._nar_index.setdefault(nar_hash, (offset, length))
+
+        return True
+
+    def scan_nar_for_dedup(self, nar_hash, fp):
+        # first step of file deduplication: hash the big files in each nar to
+        # find out which contents are duplicated. each nar should be scanned
+        # once, before any narinfos are written.
+
+        file_hashes = []
+        def contents_fn(size, fp):
+            if size < DEDUP_MIN_FILE_SIZE:
+                read_exact(fp, size)
+                return
+
+            h = hashlib.sha256()
+            copy_exact(fp, size, h.update)
+            file_hash = h.digest()
+            file_hashes.append(file_hash)
+            self._dedup_counts[file_hash] = \
+                self._dedup_counts.get(file_hash, 0) + 1
+
+        NarParser(fp, lambda data: None, contents_fn).parse()
+        self._dedup_nar_files[nar_hash] = file_hashes
+
+    def finish_dedup_scan(self):
+        # decide which files to deduplicate now that every nar is scanned, and
+        # return the hashes of the nars that need to be given to
+        # sink_dedup_files_from to write them out
+
+        self._dedup_files = {file_hash
+            for file_hash, count in self._dedup_counts.items() if count > 1}
+
+        source_nars = []
+        found = set()
+        for nar_hash, file_hashes in self._dedup_nar_files.items():
+            dup_hashes = set(file_hashes) & self._dedup_files
+            if len(dup_hashes) == 0:
+                continue
+            self._dedup_nars.add(nar_hash)
+            if len(dup_hashes - found) > 0:
+                source_nars.append(nar_hash)
+                found |= dup_hashes
+
+        return source_nars
+
+    def sink_dedup_files_from(self, nar_hash, fp):
+        # write the deduplicated files out of a nar returned by
+        # finish_dedup_scan which haven't been written yet
+        self._finish_narinfos()
+
+        file_hashes = iter(self._dedup_nar_files[nar_hash])
+        def contents_fn(size, fp):
+            if size < DEDUP_MIN_FILE_SIZE:
+                read_exact(fp, size)
+                return
+
+            file_hash = next(file_hashes)
+            if file_hash not in self._dedup_files or \
+                    file_hash in self._dedup_written:
+                copy_exact(fp, size, lambda data: None)
+                return
+
+            self._dedup_written.add(file_hash)
+            self._write_dedup_file(file_hash.hex(), size, FrameReader(fp, size))
+
+        NarParser(fp, lambda data: None, contents_fn).parse()
+
+    def _write_dedup_file(self, file_hash, size, fp):
+        name = f"shipfile/store/file/{file_hash}"
+        if not self._is_seekable:
+            self._write_fp(name, size, fp)
+            return
+
+        # in its own frame so the receiver only has to decompress the files
+        # needed by the nars it reads
+        offset = self._end_frame()
+        self._write_fp(name, size, fp)
+        self._file_index[file_hash] = (offset, self._end_frame() - offset)
+
+    def _sink_nar_dedup_into(self, nar_hash, nar_size, fp):
+        # write the nar as a skeleton, which has the nar's data except that the
+        # contents of deduplicated files are replaced by their hash
+
+        file_hashes = iter(self._dedup_nar_files[nar_hash])
+        skeleton_path = self.workdir/"nar.dedup"
+        with open(skeleton_path, "wb") as skeleton:
+            literal = bytearray()
+            def flush_literal():
+                if len(literal) > 0:
+                    skeleton.write(b"L"+struct.pack("<Q", len(literal)))
+                    skeleton.write(literal)
+                    literal.clear()
+
+            def literal_fn(data):
+                literal.extend(data)
+                if len(literal) >= 1048576:
+                    flush_literal()
+
+            def contents_fn(size, fp):
+                if size >= DEDUP_MIN_FILE_SIZE:
+                    file_hash = next(file_hashes)
+                    if file_hash in self._dedup_files:
+                        copy_exact(fp, size, lambda data: None)
+                        flush_literal()
+                        skeleton.write(b"F"+file_hash)
+                        return
+
+                copy_exact(fp, size, literal_fn)
+
+            NarParser(fp, literal_fn, contents_fn).parse()
+            flush_literal()
+
+        with open(skeleton_path, "rb") as skeleton:
+            self._write_nar_member(nar_hash,
+                nar_member_name(nar_hash, "dedup"),
+                skeleton_path.stat().st_size, skeleton)
+        skeleton_path.unlink()
+
+    def sink_nar_patch_into(self, nar_hash, nar_size, fp, base_nar):
+        # write a nar into the shipfile as a patch against the contents of
+        # base_nar, which the receiver must already have
+        self._finish_narinfos()
+
+        # the patch size has to be known to write the tar header, so make the
+        # patch in the workdir first
+        with self._nar_phase("compress patch", nar_hash, nar_size):
+            patch_path = self.workdir/"nar.patch"
+            compressor = get_patch_compressor(self._compression, base_nar,
+                nar_size)
+            with open(patch_path, "wb") as patch_fp:
+                compressor.copy_stream(FrameReader(fp, nar_size), patch_fp,
+                    size=nar_size)
+
+            with open(patch_path, "rb") as patch_fp:
+                self._write_nar_member(nar_hash,
+                    nar_member_name(nar_hash, "patch"),
+                    patch_path.stat().st_size, patch_fp)
+            patch_path.unlink()
 
 class SplitReader:
-    def __init__(self, path):
+    # parts of split shipfiles are memory mapped so reads hand out views of the
+    # mapping instead of copying the data. the kernel is asked to start reading
+    # the next part in the background so moving between parts doesn't stall on
+    # slow media. a read error in a mapping kills us with SIGBUS instead of
+    # raising, and big mappings fail on 32-bit systems, so anything else, or
+    # anything that can't be mapped, is read normally.
+
+    def __init__(self, path, is_split=True):
         self._path = str(path)
+        # if not split, this just reads the one file. the reader doesn't know
+        # if it's split until it's already started, so it can be switched on.
+        self._is_split = is_split
 
+        self._part_sizes = None
+        self._map = None
+        self._part_file = None
         # eagerly open file in case there's a problem
-        self._file = open(self._path, "rb")
-        self._file_number = 0
+        self._open_part(0)
+
+    def set_split(self):
+        self._is_split = True
+        self._part_sizes = None
+        self._prefetch_part(self._file_number+1)
+
+    def _part_path(self, number):
+        if number == 0:
+            return self._path
+        return self._path+"."+str(number)
+
+    def _map_part(self, f, size):
+        # return a mapping of the part file, or None if it shouldn't be mapped
+        if not self._is_split or size == 0 or size > MAX_MAP_SIZE:
+            return None
+        try:
+            part_map = mmap.mmap(f.fileno(), size, access=mmap.ACCESS_READ)
+        except (OSError, ValueError, OverflowError):
+            return None
+        if hasattr(part_map, "madvise"):
+            part_map.madvise(mmap.MADV_SEQUENTIAL)
+        # the mapping is closed once this and any views handed out are gone
+        return memoryview(part_map)
+
+    def _open_part(self, number):
+        f = open(self._part_path(number), "rb")
+        try:
+            size = os.fstat(f.fileno()).st_size
+            part_map = self._map_part(f, size)
+        except BaseException:
+            f.close()
+            raise
+
+        self._close_part()
+        if part_map is not None:
+            f.close()
+            self._map = part_map
+        else:
+            self._part_file = f
+        self._part_size = size
+        self._pos = 0
+        self._file_number = number
 
-    def read(self, length):
-        if self._file is None:
-            # open the next file now that data from it is needed
+        if self._is_split:
+            self._prefetch_part(number+1)
+
+    def _close_part(self):
+        self._map = None
+        if self._part_file is not None:
+            self._part_file.close()
+            self._part_file = None
+
+    def _prefetch_part(self, number):
+        if not hasattr(os, "posix_fadvise"):
+            return
+
+        def prefetch():
             try:
-                self._file_number += 1
-                self._file = open(self._path+"."+str(self._file_number), "rb")
-            except FileNotFoundError as e:
-                raise ShipfileError("split shipfile incomplete") from e
+                fd = os.open(self._part_path(number), os.O_RDONLY)
+            except FileNotFoundError: # it's the last part
+                return
+            try:
+                os.posix_fadvise(fd, 0, SPLIT_PREFETCH_SIZE,
+                    os.POSIX_FADV_WILLNEED)
+            finally:
+                os.close(fd)
+
+        # opening and advising can block on slow media so get it out of the way
+        threading.Thread(target=prefetch, daemon=True).start()
+
+    def _get_part_sizes(self):
+        # the parts can't change while we're reading them so only check once
+        if self._part_sizes is None:
+            part_sizes = []
+            while len(part_sizes) == 0 or self._is_split:
+                try:
+                    st = os.stat(self._part_path(len(part_sizes)))
+                except FileNotFoundError:
+                    break
+                part_sizes.append(st.st_size)
+            self._part_sizes = part_sizes
+
+        return self._part_sizes
+
+    def seekable(self):
+        return True
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        part_sizes = self._get_part_sizes()
+        if whence == os.SEEK_END:
+            offset += sum(part_sizes)
+        elif whence != os.SEEK_SET:
+            raise ValueError(f"unsupported whence {whence}")
+
+        # find the part the offset lands in
+        pos = offset
+        for file_number, part_size in enumerate(part_sizes):
+            if pos < part_size or file_number == len(part_sizes)-1:
+                break
+            pos -= part_size
+        else:
+            raise ShipfileError("split shipfile incomplete")
 
-        data = self._file.read(length)
-        if len(data) < length: # didn't get enough, assume this file is over
-            self._file.close()
-            # don't open the next one yet because we might not need it
-            self._file = None
+        if (self._map is None and self._part_file is None) or \
+                file_number != self._file_number:
+            self._open_part(file_number)
+        if self._part_file is not None:
+            self._part_file.seek(pos)
+        self._pos = pos
 
-        return data
+        return offset
+
+    def _read_part(self, end):
+        if self._map is not None:
+            return self._map[self._pos:end]
+
+        try:
+            return self._part_file.read(end-self._pos)
+        except OSError as e:
+            raise ShipfileError(f"could not read shipfile: {e}") from e
+
+    def read(self, length=-1):
+        while True:
+            if self._map is None and self._part_file is None:
+                if not self._is_split: # there is no next file
+                    return b""
+                # open the next file now that data from it is needed
+                try:
+                    self._open_part(self._file_number+1)
+                except FileNotFoundError as e:
+                    raise ShipfileError("split shipfile incomplete") from e
+
+            if length < 0:
+                end = self._part_size
+            else:
+                end = min(self._pos+length, self._part_size)
+            wanted = end-self._pos
+            data = self._read_part(end)
+            self._pos += len(data)
+            # a short read means the file is over sooner than it said
+            if self._pos >= self._part_size or len(data) < wanted:
+                # don't open the next one yet because we might not need it
+                self._close_part()
+
+            # an empty read just means the last file ended exactly where the
+            # previous read stopped, which is not the end of the data
+            if len(data) > 0 or length == 0:
+                return data
 
     def close(self):
-        if self._file is not None:
-            self._file.close()
+        self._close_part()
+
+class FrameReader:
+    # reads at most a given length from a file, to give zstd just one frame
+
+    def __init__(self, file, length):
+        self._file = file
+        self._remaining = length
+
+    def read(self, length):
+        length = min(length, self._remaining)
+        if length <= 0:
+            return b""
+
+        data = self._file.read(length)
+        self._remaining -= len(data)
+        return data
+
+    def readinto(self, b):
+        b = memoryview(b)[:max(self._remaining, 0)]
+        if len(b) == 0:
+            return 0
+
+        num_read = self._file.readinto(b)
+        self._remaining -= num_read
+        return num_read
+
+    def read_all(self):
+        # the file might give us short reads, e.g. at split part boundaries
+        chunks = []
+        while True:
+            data = self.read(self._remaining)
+            if len(data) == 0:
+                return b"".join(chunks)
+            chunks.append(data)
+
+class DedupNarReader:
+    # rebuilds a nar out of its skeleton and the deduplicated files
+
+    def __init__(self, fp, files_dir):
+        self._fp = fp
+        self._files_dir = files_dir
+        self._curr = None
+        self._remaining = 0
+
+    def _next_segment(self):
+        if self._curr is not None and self._curr is not self._fp:
+            self._curr.close()
+        self._curr = None
+
+        tag = self._fp.read(1)
+        if tag == b"":
+            return False
+        elif tag == b"L": # literal nar data follows
+            self._curr = self._fp
+            self._remaining = struct.unpack("<Q", read_exact(self._fp, 8))[0]
+        elif tag == b"F": # contents of a deduplicated file
+            file_hash = read_exact(self._fp, 32).hex()
+            try:
+                self._curr = open(self._files_dir/file_hash, "rb")
+            except FileNotFoundError as e:
+                raise ShipfileError(
+                    f"missing deduplicated file {file_hash}") from e
+            self._remaining = os.fstat(self._curr.fileno()).st_size
+        else:
+            raise ShipfileError(f"invalid nar skeleton tag {tag!r}")
+
+        return True
+
+    def readinto(self, b):
+        while self._remaining == 0:
+            if not self._next_segment():
+                return 0
+
+        num_read = self._curr.readinto(b[:min(len(b), self._remaining)])
+        if num_read == 0:
+            raise ShipfileError("nar skeleton is truncated")
+        self._remaining -= num_read
+        return num_read
+
+    def read(self, size=-1):
+        chunks = []
+        while size != 0:
+            buf = bytearray(1048576 if size < 0 else min(size, 1048576))
+            num_read = self.readinto(buf)
+            if num_read == 0:
+                break
+            chunks.append(bytes(buf[:num_read]))
+            if size > 0:
+                size -= num_read
+
+        return b"".join(chunks)
 
 class ShipfileReader:
     def __init__(self, workdir, path):
@@ -217,26 +960,62 @@ class ShipfileReader:
         self.workdir.mkdir(parents=True)
         self._path = path
 
-        self._is_split = False # assume the file is not split
-        self._open() # open it that way
+        self._open()
 
         self._state = "initial"
         self._ungot_entry = None
+        self._is_seekable = False
+        self._nar_index = None
+        self._file_index = None
+
+        # nar hash -> (base path, base nar hash) of nars stored as patches
+        self.nar_patches = {}
+        # nar hash -> url of the member with that nar's data
+        self._nar_urls = {}
+        # nar hash -> hashes of the deduplicated files its skeleton uses
+        self._dedup_nar_files = {}
+        # file hash -> number of nars still to be read which use it, if we
+        # were told which nars will be read
+        self._dedup_uses = None
+        self._patch_base_source = None
+
+        # worked out from the path infos when first needed
+        self._sorted_path_infos = None
+        self._store_graph = None
 
     def _open(self):
         # set max window size to accommodate the large window modes from the
         # shipfile sender
-        decompressor = zstandard.ZstdDecompressor(max_window_size=2**31)
-        if self._is_split:
-            self._file = SplitReader(self._path)
+        self._decompressor = zstandard.ZstdDecompressor(max_window_size=2**31)
+        if str(self._path) == "-":
+            self._file = sys.stdin.buffer
         else:
-            self._file = open(self._path, "rb")
-        self._reader = decompressor.stream_reader(self._file)
+            # assume the file is not split until the version info says it is
+            self._file = SplitReader(self._path, is_split=False)
+        # seekable shipfiles contain many frames, so keep reading past the end
+        # of each one
+        self._reader = self._decompressor.stream_reader(self._file,
+            read_across_frames=True)
         self._tar = tarfile.open(fileobj=self._reader, mode="r:")
+        self._closed = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
 
     def close(self):
+        if self._closed:
+            return
+        self._closed = True
         self._ungot_entry = None
         self._tar.close()
+        if not isinstance(self._file, SplitReader):
+            # read the rest of the stream so whatever is sending it doesn't
+            # see a broken pipe
+            while len(self._file.read(1048576)) > 0:
+                pass
         self._reader.close()
         self._file.close()
 
@@ -258,6 +1037,26 @@ class ShipfileReader:
 
         return entry
 
+    def _read_member(self, entry, max_size=MAX_METADATA_SIZE):
+        if entry.size > max_size:
+            raise ShipfileError(f"{entry.name} is too large")
+
+        return self._tar.extractfile(entry).read(entry.size)
+
+    @property
+    def sorted_path_infos(self):
+        # path_infos in topological order, computed once
+        if self._sorted_path_infos is None:
+            self._sorted_path_infos = sort_path_infos(self.path_infos,
+                graph=self.store_graph)
+        return self._sorted_path_infos
+
+    @property
+    def store_graph(self):
+        if self._store_graph is None:
+            self._store_graph = StoreGraph(self.path_infos)
+        return self._store_graph
+
     def _unget_entry(self, entry):
         # take an entry and return it from _next_entry next time
 
@@ -281,7 +1080,7 @@ class ShipfileReader:
             raise ShipfileError("shipfile starts with incorrect entry "
                 f"{entry.name}")
 
-        contents = self._tar.extractfile(entry).read(entry.size).decode("utf8")
+        contents = self._read_member(entry).decode("utf8")
         version_info = json.loads(contents)
 
         # very first check in case something changes drastically
@@ -300,12 +1099,32 @@ class ShipfileReader:
         except KeyError:
             pass
         else:
-            # it's split, so close the file and reopen it in split mode. the
-            # metadata handle function will safely ignore seeing the version
-            # info entry again.
-            self.close()
-            self._is_split = True
-            self._open()
+            # it's split, so carry on into the next files once the first one
+            # runs out. a stream is already all the parts stuck together.
+            if isinstance(self._file, SplitReader):
+                self._file.set_split()
+
+        # we understand these but don't need to do anything special until we
+        # come across a narinfo which uses them
+        self._mandatory_features.discard("nar_patch")
+        self._mandatory_features.discard("file_dedup")
+
+        try:
+            self._mandatory_features.remove("seekable_index")
+        except KeyError:
+            pass
+        else:
+            # we can only jump around if the underlying file lets us. if not,
+            # the nars can still be read in order like normal.
+            self._is_seekable = self._file.seekable()
+
+        # the narinfos are still there if we didn't understand the index
+        try:
+            self._optional_features.remove("narinfo_index")
+        except KeyError:
+            self._has_narinfo_index = False
+        else:
+            self._has_narinfo_index = True
 
         if len(self._mandatory_features) > 0:
             raise ShipfileError("unknown mandatory features "
@@ -356,33 +1175,56 @@ class ShipfileReader:
             if entry is None:
                 break
 
+            # deduplicated files are only extracted as the nars that need
+            # them are read
             if (not entry.name.startswith("shipfile/store/")) or \
-                    entry.name.startswith("shipfile/store/nar/"):
+                    entry.name.startswith("shipfile/store/nar/") or \
+                    entry.name.startswith("shipfile/store/file/"):
                 self._unget_entry(entry)
                 break
 
             if entry.name == "shipfile/store/nix-cache-info":
                 self.cache_info = self._read_cache_info(entry)
+            elif entry.name == "shipfile/store/narinfo.index" and \
+                    self._has_narinfo_index and len(self.path_infos) == 0 and \
+                    entry.size <= MAX_INDEX_SIZE:
+                # an index too big to read is passed over, and the narinfos
+                # after it are read instead
+                entries, narinfo_size = self._read_narinfo_index(entry)
+                for path_info, url, patch_base, dedup_files in entries:
+                    self._add_narinfo(path_info, url, patch_base, dedup_files)
+                # the index says everything the narinfos after it do, so we
+                # can skip straight past them
+                self._tar.offset += narinfo_size
             elif entry.name.endswith(".narinfo"):
-                path_info, in_file = self._read_narinfo(entry)
-                self.path_infos.append(path_info)
-                if in_file:
-                    self.path_list.append(path_info.path)
+                self._add_narinfo(*self._read_narinfo(entry))
 
         if self.cache_info is None:
             raise ShipfileError("nix-cache-info is missing")
 
         self._state = "read_nar"
 
+    def _add_narinfo(self, path_info, url, patch_base, dedup_files):
+        in_file = url != ""
+        if in_file:
+            self._nar_urls.setdefault(path_info.nar_hash, url)
+        if url.endswith(".dedup"):
+            self._dedup_nar_files.setdefault(path_info.nar_hash, dedup_files)
+        if patch_base is not None:
+            self.nar_patches[path_info.nar_hash] = patch_base
+        self.path_infos.append(path_info)
+        if in_file:
+            self.path_list.append(path_info.path)
+
     def _read_config_info(self, entry):
-        contents = self._tar.extractfile(entry).read(entry.size).decode("utf8")
+        contents = self._read_member(entry).decode("utf8")
         config_info = json.loads(contents)
 
         # remove indirection of path key
         return {k: v["path"] for k, v in config_info.items()}
 
     def _read_cache_info(self, entry):
-        contents = self._tar.extractfile(entry).read(entry.size).decode("utf8")
+        contents = self._read_member(entry).decode("utf8")
         cache_info = parse_nix_kv(contents)
 
         if cache_info["StoreDir"] != "/nix/store":
@@ -392,7 +1234,7 @@ class ShipfileReader:
         return cache_info
 
     def _read_narinfo(self, entry):
-        contents = self._tar.extractfile(entry).read(entry.size).decode("utf8")
+        contents = self._read_member(entry).decode("utf8")
         narinfo = parse_nix_kv(contents)
 
         if narinfo["Compression"] != "none" or \
@@ -400,7 +1242,7 @@ class ShipfileReader:
                 narinfo["FileHash"] != narinfo["NarHash"]:
             raise ShipfileError("invalid compression situation")
 
-        in_file = narinfo["URL"] != ""
+        url = narinfo["URL"]
         refs = ["/nix/store/"+r.strip() for r in narinfo["References"].split()]
         deriver = narinfo.get("Deriver", "")
         if deriver != "":
@@ -410,6 +1252,12 @@ class ShipfileReader:
             sigs = [sigs]
         ca_info = narinfo.get("CA", "")
 
+        patch_base = None
+        if "PatchBase" in narinfo:
+            patch_base = ("/nix/store/"+narinfo["PatchBase"],
+                narinfo["PatchBaseHash"])
+        dedup_files = narinfo.get("DedupFiles", "").split()
+
         path_info = PathInfo(path=narinfo["StorePath"],
             deriver=deriver,
             references=refs,
@@ -419,18 +1267,334 @@ class ShipfileReader:
             sigs=sigs
         )
 
-        return path_info, in_file
+        return path_info, url, patch_base, dedup_files
+
+    def _read_narinfo_index(self, entry):
+        contents = self._read_member(entry, max_size=MAX_INDEX_SIZE)
+        try:
+            return load_narinfo_index(contents)
+        except NarinfoIndexError as e:
+            raise ShipfileError(str(e)) from e
+
+    def set_nars_to_read(self, nar_hashes):
+        # say which nars will be read, counting repeats, so that only the
+        # deduplicated files they use are extracted and each is deleted once
+        # the last nar using it has been read. otherwise every file is kept
+        # until the workdir is cleaned up.
+        uses = {}
+        for nar_hash in nar_hashes:
+            for file_hash in self._dedup_nar_files.get(nar_hash, []):
+                uses[file_hash] = uses.get(file_hash, 0) + 1
+        self._dedup_uses = uses
+
+    def _read_dedup_file(self, entry, tar):
+        # keep a deduplicated file on disk until the nars that need it come,
+        # unless none of them will be read
+        file_hash = entry.name.split("/")[-1]
+        if len(file_hash) != 64 or \
+                file_hash.strip("0123456789abcdef") != "":
+            raise ShipfileError(f"invalid deduplicated file {entry.name}")
+        if self._dedup_uses is not None and file_hash not in self._dedup_uses:
+            return
+
+        files_dir = self.workdir/"files"
+        files_dir.mkdir(exist_ok=True)
+        with open(files_dir/file_hash, "wb") as f:
+            shutil.copyfileobj(tar.extractfile(entry), f)
+
+    def _release_dedup_files(self, nar_hash):
+        # delete the files of a nar which was just read that no nar still to be
+        # read uses
+        if self._dedup_uses is None:
+            return
+
+        for file_hash in self._dedup_nar_files.get(nar_hash, []):
+            uses = self._dedup_uses.get(file_hash, 0) - 1
+            if uses > 0:
+                self._dedup_uses[file_hash] = uses
+            else:
+                self._dedup_uses.pop(file_hash, None)
+                (self.workdir/"files"/file_hash).unlink(missing_ok=True)
+
+    def _open_frame(self, offset, length):
+        # open a tarfile over the single zstd frame at the given offset
+        self._file.seek(offset)
+        frame_reader = self._decompressor.stream_reader(
+            FrameReader(self._file, length))
+        return tarfile.open(fileobj=frame_reader, mode="r:")
+
+    def _read_nar_index(self):
+        self._file.seek(-SEEKABLE_FOOTER_SIZE, os.SEEK_END)
+        footer = FrameReader(self._file, SEEKABLE_FOOTER_SIZE).read_all()
+        if len(footer) != SEEKABLE_FOOTER_SIZE:
+            raise ShipfileError("seekable index footer is truncated")
+        magic, footer_len, index_offset, index_length, tag = struct.unpack(
+            SEEKABLE_FOOTER_FORMAT, footer)
+        if magic != SEEKABLE_FOOTER_MAGIC or \
+                footer_len != SEEKABLE_FOOTER_SIZE-8 or \
+                tag != SEEKABLE_FOOTER_TAG:
+            raise ShipfileError("seekable index footer is invalid")
+
+        with self._open_frame(index_offset, index_length) as tar:
+            entry = tar.next()
+            if entry is None or \
+                    entry.name != "shipfile/index/nar_index.json":
+                raise ShipfileError("seekable index is missing")
+            if entry.size > MAX_INDEX_SIZE:
+                raise ShipfileError("seekable index is too large")
+            contents = tar.extractfile(entry).read(entry.size).decode("utf8")
+
+        index = json.loads(contents)
+        return ({nar_hash: (v["offset"], v["length"])
+                for nar_hash, v in index["nars"].items()},
+            {file_hash: (v["offset"], v["length"])
+                for file_hash, v in index.get("files", {}).items()})
+
+    def set_patch_base_source(self, base_source_fn):
+        # set the function which is given the path of a patch base and returns
+        # the contents of its nar
+        self._patch_base_source = base_source_fn
+
+    def _nar_member(self, nar_hash):
+        return "shipfile/store/"+self._nar_urls.get(nar_hash,
+            nar_member_name(nar_hash))
+
+    def _apply_dedup(self, nar_hash, nar_sink_fn):
+        # wrap nar_sink_fn so it is given the nar instead of its skeleton
+        if not self._nar_member(nar_hash).endswith(".dedup"):
+            return nar_sink_fn
+
+        def dedup_sink_fn(fp):
+            nar_sink_fn(DedupNarReader(fp, self.workdir/"files"))
+            self._release_dedup_files(nar_hash)
+
+        return dedup_sink_fn
+
+    def _apply_patch(self, nar_hash, nar_sink_fn):
+        # wrap nar_sink_fn so it is given the patched nar instead of the patch
+        if nar_hash not in self.nar_patches:
+            return nar_sink_fn
+
+        base_path, _ = self.nar_patches[nar_hash]
+        if self._patch_base_source is None:
+            raise ShipfileError(f"no source for patch base {base_path}")
+
+        def patched_sink_fn(fp):
+            base_nar = self._patch_base_source(base_path)
+            decompressor = zstandard.ZstdDecompressor(
+                dict_data=get_patch_dict(base_nar), max_window_size=2**31)
+            nar_sink_fn(decompressor.stream_reader(fp))
+
+        return patched_sink_fn
+
+    def _extract_dedup_files_seekable(self, nar_hash):
+        # pull the deduplicated files the nar uses out of their own frames, as
+        # the nar's skeleton can't be read while we jump around
+        files_dir = self.workdir/"files"
+        for file_hash in self._dedup_nar_files.get(nar_hash, []):
+            if (files_dir/file_hash).exists():
+                continue
+            try:
+                offset, length = self._file_index[file_hash]
+            except KeyError:
+                raise ShipfileError(
+                    f"could not find deduplicated file {file_hash}")
+
+            with self._open_frame(offset, length) as tar:
+                entry = tar.next()
+                if entry is None or \
+                        entry.name != f"shipfile/store/file/{file_hash}":
+                    raise ShipfileError(f"seekable index points to wrong "
+                        f"file for {file_hash}")
+                self._read_dedup_file(entry, tar)
+
+    def _source_nar_seekable(self, nar_hash, nar_sink_fn):
+        if self._nar_index is None:
+            self._nar_index, self._file_index = self._read_nar_index()
+
+        self._extract_dedup_files_seekable(nar_hash)
+
+        path = self._nar_member(nar_hash)
+        try:
+            offset, length = self._nar_index[nar_hash]
+        except KeyError:
+            raise ShipfileError(f"could not find nar {path}")
+
+        with self._open_frame(offset, length) as tar:
+            entry = tar.next()
+            if entry is None or entry.name != path:
+                raise ShipfileError(f"seekable index points to wrong nar "
+                    f"for {path}")
+
+            nar_sink_fn(tar.extractfile(entry))
 
     def source_nar_into(self, nar_hash, nar_sink_fn):
         # read a nar from the shipfile, taking a function which is provided the
         # fp and that reads the nar data out of it
 
-        path = f"shipfile/store/nar/{nar_hash.split(':')[1]}.nar"
+        nar_sink_fn = self._apply_patch(nar_hash, nar_sink_fn)
+        nar_sink_fn = self._apply_dedup(nar_hash, nar_sink_fn)
+
+        if self._is_seekable:
+            # jump straight to the frame containing the nar
+            return self._source_nar_seekable(nar_hash, nar_sink_fn)
+
+        path = self._nar_member(nar_hash)
         while True:
             entry = self._next_entry()
             if entry is None:
                 raise ShipfileError(f"could not find nar {path}")
             if entry.name == path:
                 break
+            if entry.name.startswith("shipfile/store/file/"):
+                self._read_dedup_file(entry, self._tar)
 
         nar_sink_fn(self._tar.extractfile(entry))
+
+class _ReadAheadStopped(Exception):
+    pass
+
+class NarReadAhead:
+    # decompresses nars from a shipfile on a background thread into a ring of
+    # reusable buffers so that decompression overlaps with whatever is
+    # consuming the nars, e.g. the store. nars must be consumed in the order
+    # given.
+
+    def __init__(self, sf, path_infos, num_buffers=8, buffer_size=1048576):
+        self._sf = sf
+        self._path_infos = list(path_infos)
+        sf.set_nars_to_read(p.nar_hash for p in self._path_infos)
+        self._next_consume = 0
+
+        self._free = queue.Queue()
+        for _ in range(num_buffers):
+            self._free.put(memoryview(bytearray(buffer_size)))
+        # holds (buffer, length) for nar data, (None, 0) at the end of each nar,
+        # and (exception, 0) if decompression failed
+        self._filled = queue.Queue()
+
+        self._stopping = False
+        self._thread = None
+
+    def __enter__(self):
+        self._thread = threading.Thread(target=self._decompress, daemon=True)
+        self._thread.start()
+
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self._stopping = True
+        # give back buffers so the thread is not stuck waiting for one
+        while self._thread.is_alive():
+            try:
+                buf, _ = self._filled.get(timeout=0.1)
+            except queue.Empty:
+                continue
+            if isinstance(buf, memoryview):
+                self._free.put(buf)
+        self._thread.join()
+
+    def _decompress(self):
+        try:
+            for path_info in self._path_infos:
+                # includes time waiting for the consumer to free up a buffer
+                with stats.phase("decompress", bytes_out=path_info.nar_size,
+                        nar=path_info.nar_hash):
+                    self._sf.source_nar_into(path_info.nar_hash,
+                        lambda fp: self._fill(fp, path_info.nar_size))
+                self._filled.put((None, 0))
+        except _ReadAheadStopped:
+            pass
+        except BaseException as e:
+            self._filled.put((e, 0))
+
+    def _fill(self, fp, size):
+        while size > 0:
+            with stats.span("wait for free buffer"):
+                buf = self._free.get()
+            if self._stopping:
+                raise _ReadAheadStopped()
+
+            with stats.span("decode chunk"):
+                num_read = fp.readinto(buf[:min(size, len(buf))])
+            if num_read == 0:
+                self._free.put(buf)
+                break
+
+            self._filled.put((buf, num_read))
+            size -= num_read
+
+    def source_nar_into(self, nar_hash, nar_sink_fn):
+        # same as ShipfileReader.source_nar_into but must be called for each
+        # nar in order
+
+        idx = self._next_consume
+        if idx >= len(self._path_infos) or \
+                self._path_infos[idx].nar_hash != nar_hash:
+            raise RuntimeError(f"nar {nar_hash} requested out of order")
+        self._next_consume += 1
+
+        fp = _RingReader(self._free, self._filled)
+        try:
+            nar_sink_fn(fp)
+        finally:
+            # skip whatever the sink didn't want so the next nar lines up
+            fp.drain()
+
+class _RingReader:
+    # file-like object which reads one nar's worth of buffers out of the ring
+
+    def __init__(self, free, filled):
+        self._free = free
+        self._filled = filled
+        self._buf = None
+        self._pos = 0
+        self._len = 0
+        self._done = False
+
+    def _next_buf(self):
+        # make sure there is unread data in the current buffer, returning
+        # False at the end of the nar
+        while self._buf is None or self._pos == self._len:
+            if self._buf is not None:
+                self._free.put(self._buf)
+                self._buf = None
+            if self._done:
+                return False
+
+            with stats.span("wait for decompress"):
+                buf, length = self._filled.get()
+            if buf is None:
+                self._done = True
+            elif isinstance(buf, BaseException):
+                self._done = True
+                raise buf
+            else:
+                self._buf, self._pos, self._len = buf, 0, length
+
+        return True
+
+    def readinto(self, b):
+        if len(b) == 0 or not self._next_buf():
+            return 0
+
+        amount = min(len(b), self._len-self._pos)
+        b[:amount] = self._buf[self._pos:self._pos+amount]
+        self._pos += amount
+        return amount
+
+    def read(self, size=-1):
+        chunks = []
+        while size != 0 and self._next_buf():
+            amount = self._len-self._pos
+            if size > 0:
+                amount = min(amount, size)
+                size -= amount
+            chunks.append(bytes(self._buf[self._pos:self._pos+amount]))
+            self._pos += amount
+
+        return b"".join(chunks)
+
+    def drain(self):
+        while self._next_buf():
+            self._pos = self._len
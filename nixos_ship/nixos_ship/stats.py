@@ -0,0 +1,265 @@
+# collects how long each phase of creating or importing a shipfile takes and
+# how much data goes through it, to find out what's slow.
+#
+# collection is switched on for the whole program with enable(), after which
+# each `with phase(name):` adds its wall time and the CPU time of its thread to
+# that phase's totals. phases run on different threads at once (e.g. exporting
+# and compressing), so their times can add up to more than the total.
+#
+# totals don't show where things stall, so each phase, and each finer grained
+# span(), can also be recorded as an event on its thread's timeline once
+# enable_trace() is called. the timeline is written in the Chrome trace event
+# format, which chrome://tracing and ui.perfetto.dev can show. when neither is
+# on, phase() and span() do next to nothing.
+
+import contextlib
+import json
+import os
+import threading
+import time
+
+_stats = None # the Stats being collected into, if enabled
+_trace = None # the Trace being recorded into, if enabled
+
+class PhaseRecord:
+    # given to the body of a phase to say how many bytes it took and gave
+    __slots__ = ("bytes_in", "bytes_out")
+
+    def __init__(self, bytes_in, bytes_out):
+        self.bytes_in = bytes_in
+        self.bytes_out = bytes_out
+
+class Stats:
+    def __init__(self, command):
+        self.command = command
+        self._lock = threading.Lock()
+        self._phases = {} # name -> [count, wall, cpu, bytes in, bytes out]
+        # (nar hash, nar size, compressed size, if that size is just the nar's)
+        self._nars = []
+        self._start_wall = time.perf_counter()
+        self._start_cpu = time.process_time()
+
+    def add_phase(self, name, wall, cpu, bytes_in, bytes_out):
+        with self._lock:
+            totals = self._phases.setdefault(name, [0, 0.0, 0.0, 0, 0])
+            totals[0] += 1
+            totals[1] += wall
+            totals[2] += cpu
+            totals[3] += bytes_in
+            totals[4] += bytes_out
+
+    def add_nar(self, nar_hash, nar_size, compressed_size, exact):
+        with self._lock:
+            self._nars.append((nar_hash, nar_size, compressed_size, exact))
+
+    def report(self):
+        # everything collected as a JSON-able dict
+        with self._lock:
+            nar_size = sum(n[1] for n in self._nars)
+            compressed_size = None
+            if all(n[3] for n in self._nars):
+                compressed_size = sum(n[2] for n in self._nars)
+            return {
+                "command": self.command,
+                "wall_time": time.perf_counter() - self._start_wall,
+                "cpu_time": time.process_time() - self._start_cpu,
+                "phases": {name: {
+                    "count": count,
+                    "wall_time": wall,
+                    "cpu_time": cpu,
+                    "bytes_in": bytes_in,
+                    "bytes_out": bytes_out,
+                } for name, (count, wall, cpu, bytes_in, bytes_out)
+                    in self._phases.items()},
+                "nars": {
+                    "count": len(self._nars),
+                    "nar_size": nar_size,
+                    "compressed_size": compressed_size,
+                    "ratio": _ratio(nar_size, compressed_size),
+                    # sizes of nars that shared compressor frames with others
+                    # aren't known, so they and the totals are null
+                    "each": [{
+                        "nar_hash": nar_hash,
+                        "nar_size": size,
+                        "compressed_size": compressed if exact else None,
+                        "ratio": _ratio(size, compressed if exact else None),
+                    } for nar_hash, size, compressed, exact in self._nars],
+                },
+            }
+
+    def summary(self):
+        # the report in a form for people
+        report = self.report()
+        lines = [f"{'phase':<16} {'count':>7} {'wall s':>9} {'cpu s':>9} "
+            f"{'MB in':>9} {'MB out':>9} {'MB/s':>8}"]
+        for name, phase in report["phases"].items():
+            moved = max(phase["bytes_in"], phase["bytes_out"])
+            rate = moved/1e6/phase["wall_time"] if phase["wall_time"] else 0
+            lines.append(f"{name:<16} {phase['count']:>7} "
+                f"{phase['wall_time']:>9.2f} {phase['cpu_time']:>9.2f} "
+                f"{phase['bytes_in']/1e6:>9.1f} "
+                f"{phase['bytes_out']/1e6:>9.1f} {rate:>8.1f}")
+
+        lines.append(f"total: {report['wall_time']:.2f}s wall, "
+            f"{report['cpu_time']:.2f}s cpu")
+        nars = report["nars"]
+        if nars["count"] > 0:
+            if nars["ratio"] is not None:
+                lines.append(f"nars: {nars['count']}, "
+                    f"{nars['nar_size']/1e6:.1f} MB compressed to "
+                    f"{nars['compressed_size']/1e6:.1f} MB, "
+                    f"ratio {nars['ratio']:.2f}")
+            else:
+                lines.append(f"nars: {nars['count']}, "
+                    f"{nars['nar_size']/1e6:.1f} MB")
+            sized = [n for n in nars["each"] if n["ratio"] is not None]
+            if len(sized) > 0:
+                worst = min(sized, key=lambda n: n["ratio"])
+                lines.append(f"least compressible nar: {worst['nar_hash']} "
+                    f"({worst['nar_size']/1e6:.1f} MB, "
+                    f"ratio {worst['ratio']:.2f})")
+
+        return "\n".join(lines)
+
+def _ratio(size, compressed_size):
+    if compressed_size is None or compressed_size == 0:
+        return None
+    return size/compressed_size
+
+class Trace:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._events = []
+        self._thread_names = {} # thread id -> name
+        self._start = time.perf_counter()
+
+    def add_event(self, name, start, end, args):
+        thread = threading.current_thread()
+        tid = thread.native_id
+        event = {
+            "name": name,
+            "ph": "X", # complete event, with a duration
+            "ts": (start - self._start)*1e6,
+            "dur": (end - start)*1e6,
+            "pid": os.getpid(),
+            "tid": tid,
+        }
+        if args:
+            event["args"] = args
+
+        with self._lock:
+            self._events.append(event)
+            if tid not in self._thread_names:
+                self._thread_names[tid] = thread.name
+
+    def report(self):
+        # the events as a JSON-able dict, with each thread given its name
+        with self._lock:
+            names = [{
+                "name": "thread_name",
+                "ph": "M", # metadata
+                "pid": os.getpid(),
+                "tid": tid,
+                "args": {"name": name},
+            } for tid, name in self._thread_names.items()]
+            return {
+                "traceEvents": names + self._events,
+                "displayTimeUnit": "ms",
+            }
+
+def enable(command):
+    global _stats
+    _stats = Stats(command)
+    return _stats
+
+def disable():
+    global _stats
+    _stats = None
+
+def enabled():
+    return _stats is not None
+
+def enable_trace():
+    global _trace
+    _trace = Trace()
+    return _trace
+
+def disable_trace():
+    global _trace
+    _trace = None
+
+@contextlib.contextmanager
+def phase(name, bytes_in=0, bytes_out=0, **args):
+    # time the body as part of the named phase. the body can update the byte
+    # counts in the record it's given if it doesn't know them up front. args
+    # (e.g. which nar) are only kept in the trace.
+    record = PhaseRecord(bytes_in, bytes_out)
+    stats = _stats
+    trace = _trace
+    if stats is None and trace is None:
+        yield record
+        return
+
+    start_wall = time.perf_counter()
+    start_cpu = time.thread_time()
+    try:
+        yield record
+    finally:
+        end_wall = time.perf_counter()
+        if stats is not None:
+            stats.add_phase(name, end_wall - start_wall,
+                time.thread_time() - start_cpu,
+                record.bytes_in, record.bytes_out)
+        if trace is not None:
+            if record.bytes_in:
+                args["bytes_in"] = record.bytes_in
+            if record.bytes_out:
+                args["bytes_out"] = record.bytes_out
+            trace.add_event(name, start_wall, end_wall, args)
+
+@contextlib.contextmanager
+def span(name, **args):
+    # record the body on the trace timeline without counting it as a phase
+    trace = _trace
+    if trace is None:
+        yield
+        return
+
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        trace.add_event(name, start, time.perf_counter(), args)
+
+def add_nar(nar_hash, nar_size, compressed_size, exact=True):
+    # exact is False if the compressed size includes bits of other nars
+    if _stats is not None:
+        _stats.add_nar(nar_hash, nar_size, compressed_size, exact)
+
+@contextlib.contextmanager
+def collecting(command, summary, json_path, trace_path=None):
+    # collect stats and/or a trace for the body if asked, then print the
+    # summary and/or write the JSON report and trace
+    stats = None
+    if summary or json_path is not None:
+        stats = enable(command)
+    trace = None
+    if trace_path is not None:
+        trace = enable_trace()
+
+    try:
+        yield
+    finally:
+        disable()
+        disable_trace()
+        if stats is not None and summary:
+            print(stats.summary())
+        if stats is not None and json_path is not None:
+            with open(json_path, "w") as f:
+                json.dump(stats.report(), f, indent=2)
+                f.write("\n")
+        if trace is not None:
+            # can be big, so don't indent
+            with open(trace_path, "w") as f:
+                json.dump(trace.report(), f)
+                f.write("\n")